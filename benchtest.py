@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Benchmark the stages of fittest_classbased.py on synthetic trajectory files
+'''
+import getopt, json, os, platform, resource, subprocess, sys, tempfile, time, tracemalloc
+os.environ.setdefault("MPLBACKEND", "Agg") # Headless
+import numpy as np
+import fittest_classbased as fit
+
+
+def usage():
+    '''Usage function'''
+    print("""Time and memory-profile the fit pipeline on synthetic trajectory files
+
+Usage: %s -h -s [sizes] -d [directory] -o [output] -b [baseline]
+
+-h                  Show this help message and exit
+-s [sizes]          Comma separated particles x steps per particle, default 100x200,1000x200
+-d [directory]      Directory for synthetic files, default temporary
+-o [output]         JSON file to store results in, default bench.json
+-b [baseline]       JSON file of an earlier run to compare throughput with
+""" %sys.argv[0])
+
+
+def gentrajectory(file, particles, steps, seed=0):
+    '''Write synthetic trajectories in the ASCII format read by fittest_classbased.readlines'''
+    rng = np.random.default_rng(seed)
+    c = 299792458
+    z = np.linspace(-1.2, 1.2, steps)
+    with open(file, 'w') as f:
+        for id in range(1, particles + 1):
+            f.write("ID %i\n" % id)
+            if id == 1:
+                f.write(" ".join(fit.RAW) + "\n") # Caption
+            block = rng.normal(scale = 1e-3, size = (steps, len(fit.RAW)))
+            block[:, fit.RAW.index("z")] = z
+            block[:, fit.RAW.index("betaz")] += 0.5
+            block[:, fit.RAW.index("By")] += 0.1 * np.exp(-z**2)
+            block[:, fit.RAW.index("Ex")] += 1e5 * np.exp(-z**2)
+            block[:, fit.RAW.index("t")] = (z - z[0]) / (0.5 * c)
+            np.savetxt(f, block, fmt = "%.8e")
+        f.write("ID %i\n" % fit.SKIP[0]) # Particle always skipped
+        np.savetxt(f, rng.normal(size = (steps, len(fit.RAW))), fmt = "%.8e")
+
+
+def measure(stage, rows, function, *args):
+    '''Run function, return its result and wall time, CPU time, throughput and memory of the stage'''
+    tracemalloc.start()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = function(*args)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats = {"stage": stage, "rows": rows, "wall": wall, "cpu": cpu, "rows_per_s": rows / wall if wall else None,
+             "peak_alloc_mb": peak / 2**20, "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10}
+    print("%-8s %10i rows %8.3f s %12.0f rows/s %8.1f MB" % (stage, rows, wall, stats["rows_per_s"] or 0., stats["peak_alloc_mb"]))
+    return result, stats
+
+
+def readcached(file):
+    '''Read file from its cache and touch all mapped data, so the stage times reading and not only mapping'''
+    ids, data = fit.readcached(file)
+    np.asarray(ids).sum()
+    np.asarray(data).sum()
+    return ids, data
+
+
+def render(table, groups, row, file):
+    '''Plot one column of all particles and save it as PDF and PNG like fittest_classbased.main'''
+    reduced = [fit.reducetraces(table, groups, [row])]
+    fit.renderfigure(fit.figuretask([(table, groups)], reduced, 0, "By", row, file))
+
+
+def bench(directory, particles, steps):
+    '''Benchmark all stages on one file of particles x steps'''
+    file = os.path.join(directory, "bench_%ix%i.dat" % (particles, steps))
+    if not os.path.exists(file):
+        gentrajectory(file, particles, steps)
+    rows = particles * steps
+    names = fit.select(["By", "F_x"])
+    results = []
+    (ids, data), stats = measure("read", rows, fit.readlines, file)
+    results.append(stats)
+    fit.writecache(file, fit.SKIP, [(ids, data)])
+    (ids, data), stats = measure("cached", rows, readcached, file)
+    results.append(stats)
+    derived, stats = measure("derive", rows, fit.lorentz, ids, data)
+    results.append(stats)
+    table, stats = measure("select", rows, fit.lorentz, ids, data, names)
+    results.append(stats)
+    _, stats = measure("group", rows, fit.groupby, derived) # All derived columns, as before --columns
+    results.append(stats)
+    del derived
+    table, groups = fit.groupby(table) # Selected columns for reduce and render
+    _, stats = measure("reduce", rows, fit.reducetraces, table, groups, [names.index("By"), names.index("F_x")])
+    results.append(stats)
+    _, stats = measure("stream", rows, fit.streamstats, file, ["By", "F_x"])
+    results.append(stats)
+    _, stats = measure("render", rows, render, table, groups, names.index("By"), file)
+    results.append(stats)
+    for stats in results:
+        stats.update({"particles": particles, "steps": steps, "bytes": os.path.getsize(file)})
+    return results
+
+
+def commit():
+    '''Current git commit of the benchmarked code, None outside a repository'''
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    '''Print throughput relative to a baseline run'''
+    old = {(r["stage"], r["particles"], r["steps"]): r for r in baseline["results"]}
+    print("\nCompared to %s:" % baseline.get("commit"))
+    for r in results:
+        b = old.get((r["stage"], r["particles"], r["steps"]))
+        if b and b["rows_per_s"] and r["rows_per_s"]:
+            print("%-8s %ix%i: %.2fx throughput, %.2fx memory" % (r["stage"], r["particles"], r["steps"], r["rows_per_s"] / b["rows_per_s"], r["peak_alloc_mb"] / b["peak_alloc_mb"] if b["peak_alloc_mb"] else float("nan")))
+
+
+def main(argv):
+    '''read in CMD arguments'''
+    sizes = [(100, 200), (1000, 200)]
+    directory = None
+    output = "bench.json"
+    baseline = None
+    try:
+        opts, args = getopt.getopt(argv, "hs:d:o:b:")
+    except getopt.GetoptError as err:
+        print(str(err) + "\n")
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt == "-s":
+            sizes = [tuple(int(n) for n in size.split("x")) for size in arg.split(",")]
+        elif opt == "-d":
+            directory = arg
+        elif opt == "-o":
+            output = arg
+        elif opt == "-b":
+            baseline = arg
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for particles, steps in sizes:
+            print("Benchmarking %i particles x %i steps ..." % (particles, steps))
+            results += bench(directory or tmpdir, particles, steps)
+    report = {"commit": commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "numpy": np.__version__, "machine": platform.machine(), "cpus": os.cpu_count(), "results": results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent = 1)
+    print("Results written to %s" % output)
+    if baseline:
+        with open(baseline, 'r') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
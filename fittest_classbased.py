@@ -1,11 +1,6 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-import getopt, math, sys, os
-from cycler import cycler
-import matplotlib.pyplot as plt
-import matplotlib.lines as lines
-from matplotlib import cm
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+import atexit, contextlib, cProfile, csv, getopt, hashlib, io, json, marshal, math, multiprocessing, pstats, re, resource, shutil, sys, os, tempfile, time, tracemalloc
 import numpy as np
 import pickle
 from tqdm import tqdm
@@ -15,84 +10,578 @@ def usage():
     '''Usage function'''
     print("""Plot coordinates and field amplitudes along each particles trajectory
 
-Usage: %s -h -i [basename]
+Usage: %s -h -i [basename] -c [columns] -r -j [jobs] -p [report] --cprofile [stage] --density --stats-only --stream -u
 
 -h                  Show this help message and exit
 -i [basename]       Basename of ASCII file with trajectories in columns:
-                    x y z Bx By Bz Ex Ey Ez betax betay betaz
-""" %sys.argv[0])
+                    %s
+-c, --columns [columns]
+                    Comma separated names of columns to plot, only these are calculated:
+                    %s
+-r, --rebuild       Reparse ASCII files even if binary cache is up to date
+-j, --jobs [jobs]   Number of processes to read, derive and plot files in parallel
+-p, --profile [report]
+                    Write wall and CPU time, rows and peak memory of each stage to JSON file report
+--cprofile [stage]  With --profile, dump cProfile statistics of stage (read, derive, group, reduce, render, ...)
+--density           Plot 2D histograms of all particles per phase instead of one line per particle
+--stats-only        Only print statistics and write them to [basename]/[basename]_stats.csv/.json, no plots
+--stream            Like --stats-only, reading one particle at a time for files larger than memory
+-u, --update        Only parse, derive and reduce particle blocks appended to the files since the last run
+                    and merge them into the results kept in the cache, plots still read all cached data
+""" % (sys.argv[0], " ".join(RAW), ",".join(COLUMNS)))
 
 
-def readlines(file):
-    '''Read in lines as list of strings'''
-    print("Reading from %s ..." % file)
-    f = open(file, 'r')
-    lines = []
-    caption = True#False
-    for line in f:
-        if not line.split(): # Catch empty lines
-            continue
-        if line.split()[0] == "ID": # Capture particle IDs
-            id = int(float(line.split()[1]))
-            continue
-        if id in [10000]: # last particle sometimes simulated wrong
-            continue
+class Stages:
+    '''Wall and CPU time, processed rows and peak memory of named pipeline stages, does nothing unless enabled.
+    Stages run in processes of pool() are recorded there and merged into these by map().'''
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.profiled = None # name of stage to run under cProfile
+        self.profile = None
+        self.profiles = {} # cProfile statistics of the profiled stage handed back from pool processes
+
+    def enable(self, profiled=None):
+        self.enabled = True
+        self.stages = {}
+        self.profiled = profiled
+        if profiled:
+            self.profile = cProfile.Profile()
+        tracemalloc.start()
+
+    def pool(self, jobs):
+        '''Pool of jobs processes recording stages like this process'''
+        return multiprocessing.Pool(jobs, enableworker, (self.enabled, self.profiled))
+
+    def map(self, pool, function, tasks):
+        '''pool.map() of function over tasks, merging the stages recorded in the processes into these'''
+        results = []
+        for result, stages, profile in pool.map(staged, [(function, task) for task in tasks], chunksize = 1):
+            for record in stages.values():
+                stage = self.stages.setdefault(record["stage"], dict(record, calls = 0, wall = 0., cpu = 0., rows = 0, peak_alloc_mb = 0.))
+                for name in ("calls", "wall", "cpu", "rows"):
+                    stage[name] += record[name]
+                stage["peak_alloc_mb"] = max(stage["peak_alloc_mb"], record["peak_alloc_mb"])
+            for func, stat in profile.items():
+                self.profiles[func] = pstats.add_func_stats(self.profiles.get(func, (0, 0, 0, 0, {})), stat)
+            results.append(result)
+        return results
+
+    def collect(self):
+        '''Stages and cProfile statistics recorded since the last call, to hand them back from a pool process'''
+        stages, self.stages = self.stages, {}
+        profile = {}
+        if self.profile:
+            self.profile.create_stats()
+            profile = self.profile.stats
+            self.profile = cProfile.Profile()
+        return stages, profile
+
+    @contextlib.contextmanager
+    def __call__(self, name, rows=0):
+        '''Measure enclosed code as stage name, the yielded dict takes the number of rows if not known before'''
+        record = {"rows": rows}
+        if not self.enabled:
+            yield record
+            return
+        tracemalloc.reset_peak()
+        if name == self.profiled:
+            self.profile.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            cpu = time.process_time() - cpu
+            wall = time.perf_counter() - wall
+            if name == self.profiled:
+                self.profile.disable()
+            stage = self.stages.setdefault(name, {"stage": name, "calls": 0, "wall": 0., "cpu": 0., "rows": 0, "peak_alloc_mb": 0.})
+            stage["calls"] += 1
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+            stage["rows"] += record["rows"]
+            stage["peak_alloc_mb"] = max(stage["peak_alloc_mb"], tracemalloc.get_traced_memory()[1] / 2**20)
+
+    def write(self, file, argv=None):
+        '''Write JSON report of all stages, and cProfile statistics of the profiled stage next to it'''
+        for stage in self.stages.values():
+            stage["rows_per_s"] = stage["rows"] / stage["wall"] if stage["wall"] and stage["rows"] else None
+        report = {"argv": argv, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, "stages": list(self.stages.values())}
+        with open(file, 'w') as f:
+            json.dump(report, f, indent = 1)
+        print("Stage report written to %s" % file)
+        if self.profile:
+            self.profile.create_stats()
+            profile = dict(self.profile.stats)
+            for func, stat in self.profiles.items():
+                profile[func] = pstats.add_func_stats(profile.get(func, (0, 0, 0, 0, {})), stat)
+            if not profile:
+                print("Stage %s did not run, no profile written" % self.profiled)
+                return
+            with open(file + "." + self.profiled + ".prof", 'wb') as f: # Format of cProfile.Profile.dump_stats()
+                marshal.dump(profile, f)
+            print("Profile of stage %s written to %s" % (self.profiled, file + "." + self.profiled + ".prof"))
+
+
+STAGES = Stages() # instrumentation of this run, enabled by --profile
+
+
+def enableworker(enabled, profiled):
+    '''Pool initializer: record stages in the process if they are in the main process, see Stages.pool()'''
+    if enabled:
+        STAGES.enable(profiled)
+
+
+def staged(task):
+    '''Pool worker: call function on args of task = (function, args), returns its result and the stages recorded
+    meanwhile, see Stages.map()'''
+    function, args = task
+    return (function(args),) + STAGES.collect()
+
+
+SKIP = [10000] # last particle sometimes simulated wrong
+CHUNKSIZE = 1 << 24 # bytes read and parsed at once
+CACHEVERSION = 2 # increase if parsing changes, invalidates all caches
+APPENDCHECK = 1 << 16 # bytes in front of the last cached block that must be unchanged to append to a cache
+HEADER = re.compile(r"ID[ \t]+(\S+)[^\n]*") # particle ID block headers, literal prefix for fast search
+CAPTION = re.compile(r"\n[ \t]*(?![+-]?(?:nan|inf))[^\s\d+\-.][^\n]*", re.I) # lines not starting with a number
+
+
+def isheader(text, match):
+    '''Check if an ID match is the first word of its line'''
+    return not text[text.rfind("\n", 0, match.start()) + 1:match.start()].strip()
+
+
+def parselines(text):
+    '''Parse a particle block line by line into a 2D array, None if there are no lines of floats. Lines that are not
+    all floats (e.g. captions) are skipped, a line with another number of columns than the first raises ValueError.'''
+    rows = []
+    for line in text.split("\n"):
         try:
-            floats = [float(f) for f in line.split()]
-            lines.append([id] + floats)
+            row = [float(word) for word in line.split()]
         except ValueError: # Catch lines not containing floats (e.g. Captions)
-            if caption != True:
-                lines = [["id"] + line.split()] + lines
-                caption = True
             continue
-    f.close()
-    return lines
+        if not row:
+            continue
+        if rows and len(row) != len(rows[0]):
+            raise ValueError("Line of %i columns in block of %i: %s" % (len(row), len(rows[0]), line.strip()[:80]))
+        rows.append(row)
+    return np.array(rows) if rows else None
+
+
+def parseblock(text, ncolumn=None):
+    '''Parse whitespace separated floats of a particle block into a 2D array, None if there are none.
+    NumPy's C parser checks every line, only blocks it rejects are parsed again line by line by parselines().'''
+    if not text.startswith("\n"): # Line break in front of every line for fast caption search
+        text = "\n" + text
+    if CAPTION.search(text): # Drop lines not containing floats (e.g. Captions)
+        text = CAPTION.sub("", text)
+    if not text.strip(): # Catch empty lines
+        return None
+    try:
+        values = np.loadtxt(io.StringIO(text), ndmin = 2)
+    except ValueError: # Lines of other lengths or with words that are not floats
+        values = parselines(text)
+        if values is None:
+            return None
+    if ncolumn is not None and values.shape[1] != ncolumn:
+        raise ValueError("Block of %i columns after blocks of %i" % (values.shape[1], ncolumn))
+    return values
+
+
+def readsegments(file, skip=SKIP, chunksize=CHUNKSIZE, span=None):
+    '''Generate (id, rows x columns array) of particle blocks parsed in bulk chunks, a block cut by a chunk border
+    comes in two parts. Optionally only a span of (start, stop) bytes beginning at an ID header is read.'''
+    start, stop = span if span else (0, snapshot(file)[0])
+    ncolumn = None
+    id = None
+    with open(file, 'rb') as f, tqdm(total = stop - start, unit = "B", unit_scale = True) as progress:
+        f.seek(start)
+        pos = start
+        while pos < stop:
+            chunk = f.read(min(chunksize, stop - pos))
+            if not chunk:
+                break
+            if pos + len(chunk) < stop:
+                chunk += f.readline() # Complete last line of chunk
+            pos += len(chunk)
+            progress.update(len(chunk))
+            chunk = chunk.decode()
+            headers = [m for m in HEADER.finditer(chunk) if isheader(chunk, m)]
+            keys = [id] + [int(float(m.group(1))) for m in headers] # Capture particle IDs
+            starts = [0] + [m.end() for m in headers]
+            ends = [chunk.rfind("\n", 0, m.start()) + 1 for m in headers] + [len(chunk)]
+            for id, start, end in zip(keys, starts, ends):
+                if id in skip:
+                    continue
+                block = parseblock(chunk[start:end], ncolumn)
+                if block is None:
+                    continue
+                if id is None:
+                    raise ValueError("%s: Data before first particle ID" % file)
+                ncolumn = block.shape[1]
+                yield id, block
+
+
+def readlines(file, skip=SKIP, chunksize=CHUNKSIZE, span=None):
+    '''Read in trajectories in bulk chunks as particle ID array and column-wise float array'''
+    print("Reading from %s ..." % file)
+    ids = []
+    blocks = []
+    for id, block in readsegments(file, skip, chunksize, span):
+        ids.append(np.full(len(block), id, dtype = np.int64))
+        blocks.append(block)
+    if not blocks:
+        return np.empty(0, dtype = np.int64), np.empty((len(RAW), 0))
+    data = np.empty((blocks[0].shape[1], sum(len(b) for b in blocks)))
+    n = 0
+    for k, block in enumerate(blocks): # Transpose into contiguous columns, freeing parsed blocks on the way
+        data[:, n:n + len(block)] = block.T
+        n += len(block)
+        blocks[k] = None
+    return np.concatenate(ids), data
+
+
+def readblocks(file, skip=SKIP, chunksize=CHUNKSIZE):
+    '''Generate (id, column-wise float array) of one particle at a time, assumes one block per particle ID'''
+    print("Streaming from %s ..." % file)
+    key = None
+    parts = []
+    for id, block in readsegments(file, skip, chunksize):
+        if parts and id != key:
+            yield key, np.concatenate(parts).T
+            parts = []
+        key = id
+        parts.append(block)
+    if parts:
+        yield key, np.concatenate(parts).T
+
+
+def splitfile(file, n, size=None):
+    '''Split the first size bytes of file, default all, into up to n spans, each beginning at a particle ID header'''
+    size = os.path.getsize(file) if size is None else size
+    bounds = [0]
+    with open(file, 'rb') as f:
+        for k in range(1, n):
+            f.seek(max(size * k // n, bounds[-1]))
+            f.readline() # Skip to next full line
+            pos = f.tell()
+            for line in iter(f.readline, b""):
+                if line.split()[:1] == [b"ID"]:
+                    break
+                pos = f.tell()
+            bounds.append(pos)
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def snapshot(file, growing=False, chunksize=1 << 16):
+    '''Size and modification time of file, taken once before parsing it. Only these bytes are parsed and the cache
+    is stamped with them, so blocks appended during the parse are parsed on the next read. If the file is growing
+    (-u), the size ends with the last complete line, so a last line still being written is parsed on the next read,
+    else the end of the file ends the last line.'''
+    stat = os.stat(file)
+    if not growing:
+        return stat.st_size, stat.st_mtime_ns
+    with open(file, 'rb') as f:
+        end = stat.st_size
+        while end > 0:
+            start = max(0, end - chunksize)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1, stat.st_mtime_ns
+            end = start
+    return 0, stat.st_mtime_ns
+
+
+def cachekey(file, skip, snap=None):
+    '''Identify parsed content of a file by path, size and modification time of its snapshot() and skipped IDs'''
+    size, mtime = snap or snapshot(file)
+    return {"version": CACHEVERSION, "path": os.path.abspath(file), "size": size, "mtime": mtime, "skip": sorted(int(i) for i in skip)}
+
+
+def partsuffix(k):
+    '''File name suffix of cache part k, parts after the first hold blocks appended later'''
+    return "_%i" % k if k else ""
+
+
+def readkey(file):
+    '''Key of the binary cache next to file, None if missing or corrupt'''
+    try:
+        with open(file + ".cache" + os.sep + "key.json", 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def iscurrent(key, file, skip=SKIP, growing=False):
+    '''Check if a cache key still matches file'''
+    current = cachekey(file, skip, snapshot(file, growing))
+    return key is not None and {k: key.get(k) for k in current} == current
+
+
+def fingerprint(file, offset):
+    '''Hash of the APPENDCHECK bytes in front of offset, to recognize files that were only appended to'''
+    with open(file, 'rb') as f:
+        f.seek(max(0, offset - APPENDCHECK))
+        return hashlib.sha1(f.read(offset - max(0, offset - APPENDCHECK))).hexdigest()
+
+
+def lastheader(file, size=None, chunksize=1 << 16):
+    '''Byte offset of the line of the last particle ID header in the first size bytes of file, default all, and its ID,
+    (0, None) without headers'''
+    with open(file, 'rb') as f:
+        end = os.path.getsize(file) if size is None else size
+        while end > 0:
+            start = max(0, end - chunksize)
+            f.seek(start)
+            chunk = f.read(end - start).decode("latin-1") # One character per byte
+            first = chunk.find("\n") + 1 if start else 0 # First line may be cut
+            headers = [m for m in HEADER.finditer(chunk, first) if isheader(chunk, m)]
+            if headers:
+                return start + chunk.rfind("\n", 0, headers[-1].start()) + 1, int(float(headers[-1].group(1)))
+            end = start + first
+    return 0, None
+
+
+def loadcache(file, skip=SKIP, growing=False):
+    '''Memory-map parsed trajectories from binary cache next to file, None if missing or outdated'''
+    cache = file + ".cache" + os.sep
+    key = readkey(file)
+    if not iscurrent(key, file, skip, growing):
+        return None
+    try:
+        parts = [(np.load(cache + "ids%s.npy" % partsuffix(k), mmap_mode = 'r')[:n], np.load(cache + "data%s.npy" % partsuffix(k), mmap_mode = 'r')[:, :n])
+                 for k, n in enumerate(key["parts"]) if n]
+    except (OSError, ValueError): # Missing or corrupt cache
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    if not parts:
+        return np.empty(0, dtype = np.int64), np.empty((len(RAW), 0))
+    return np.concatenate([i for i, d in parts]), np.concatenate([d for i, d in parts], axis = 1) # Appended parts are joined in memory
+
+
+def writecache(file, skip, parts, keep=(), snap=None):
+    '''Write list of parsed (ids, data) parts of a file to binary cache next to it, returns success.
+    keep holds the number of valid rows of each existing cache part, if the parts are appended to those.
+    snap is the snapshot() of file taken before parsing the parts, default one taken now.'''
+    cache = file + ".cache" + os.sep
+    snap = snap or snapshot(file)
+    key = cachekey(file, skip, snap)
+    parts = [(i, d) for i, d in parts if len(i)]
+    suffix = partsuffix(len(keep))
+    try:
+        os.makedirs(cache, exist_ok = True)
+        if os.path.exists(cache + "key.json"): # Invalidate before overwriting arrays
+            os.remove(cache + "key.json")
+        n = sum(len(i) for i, d in parts)
+        ncolumn = parts[0][1].shape[0] if parts else len(RAW)
+        ids = np.lib.format.open_memmap(cache + "ids%s.npy" % suffix, mode = 'w+', dtype = np.int64, shape = (n,))
+        data = np.lib.format.open_memmap(cache + "data%s.npy" % suffix, mode = 'w+', dtype = np.float64, shape = (ncolumn, n))
+        n = 0
+        for i, d in parts:
+            ids[n:n + len(i)] = i
+            data[:, n:n + len(i)] = d
+            n += len(i)
+        offset, last = lastheader(file, snap[0]) # The last block may still grow, it is parsed again when appending
+        tail = 0
+        if n and ids[-1] == last:
+            changes = np.flatnonzero(ids != last)
+            tail = n - changes[-1] - 1 if len(changes) else n
+        ids.flush()
+        data.flush()
+        del ids, data
+        k = len(keep) + 1
+        while os.path.exists(cache + "ids%s.npy" % partsuffix(k)): # Parts of an older cache
+            os.remove(cache + "ids%s.npy" % partsuffix(k))
+            os.remove(cache + "data%s.npy" % partsuffix(k))
+            k += 1
+        key.update({"parts": list(keep) + [n], "offset": offset, "tail": int(tail), "prefix": fingerprint(file, offset)})
+        with open(cache + "key.tmp", 'w') as f:
+            json.dump(key, f)
+        os.replace(cache + "key.tmp", cache + "key.json")
+    except OSError as err:
+        print("Could not write cache %s: %s" % (cache, err))
+        return False
+    return True
+
+
+def readcached(file, skip=SKIP, rebuild=False, growing=False):
+    '''Read in trajectories memory-mapped from binary cache next to file, parse and cache them if outdated.
+    If file is growing, an unterminated last line is left for the next read, see snapshot().'''
+    cached = None if rebuild else loadcache(file, skip, growing)
+    if cached is not None:
+        print("Reading from cache %s ..." % (file + ".cache" + os.sep))
+        return cached
+    snap = snapshot(file, growing)
+    ids, data = readlines(file, skip, span = (0, snap[0]))
+    writecache(file, skip, [(ids, data)], snap = snap)
+    return ids, data
+
+
+def appendcache(file, skip=SKIP):
+    '''Parse only the blocks appended to file since its cache was written, starting again at the last cached block,
+    and add them to the cache as a new part. Returns their (ids, data), None if file was not only appended to.'''
+    key = readkey(file)
+    snap = snapshot(file, True) # A last line still being written is parsed with the next append
+    current = cachekey(file, skip, snap)
+    if key is None or any(key.get(k) != current[k] for k in ("version", "path", "skip")) or current["size"] < key["size"] \
+            or fingerprint(file, key["offset"]) != key["prefix"]:
+        return None
+    print("Appending to cache %s ..." % (file + ".cache" + os.sep))
+    ids, data = readlines(file, skip, span = (key["offset"], current["size"]))
+    keep = key["parts"]
+    keep[-1] -= key["tail"]
+    if not writecache(file, skip, [(ids, data)], keep, snap):
+        return None
+    return ids, data
+
+
+RAW = ["x", "y", "z", "betax", "betay", "betaz", "Bx", "By", "Bz", "Ex", "Ey", "Ez", "t"] # columns of ASCII input
+COLUMNS = ["id", "s", "x", "y", "z", "xprime", "yprime", "zprime", "Bx", "By", "Bz", "Ex", "Ey", "Ez", "F_Bx", "F_By", "F_Bz", "F_Ex", "F_Ey", "F_Ez", "F_x", "F_y", "F_z", "absB", "absE", "unwantedB", "unwantedE"] # names of derived columns
+#         0                1         2         3                                                      7             8             9             10              11
+LABELS = ["id", r"s / m", r"x / m", r"y / m", r"z / m", r"$x'$ / rad", r"$y'$ / rad", r"$z'$ / rad", r"$B_x$ / T", r"$B_y$ / T", r"$B_z$ / T", r"$E_x$ / V/m", r"$E_y$ / V/m", r"$E_z$ / V/m", r"$F_{Bx}$ / eV/m", r"$F_{By}$ / eV/m", r"$F_{Bz}$ / eV/m", r"$F_{Ex}$ / eV/m", r"$F_{Ey}$ / eV/m", r"$F_{Ez}$ / eV/m", r"$F_x$ / eV/m", r"$F_y$ / eV/m", r"$F_z$ / eV/m", r"|B| / T", r"|E| / V/m", r"$\sqrt{B_y^2+B_z^2}$ / T", r"$\sqrt{E_x^2+E_z^2}$ / V/m"] # plot axis labels of derived columns
+Q = 1 # charge / e
+C = 299792458 # speed of light / m/s
+DERIVED = { # quantities calculated from other columns: (columns they depend on, function of those)
+    "beta": (["betax", "betay", "betaz"], lambda bx, by, bz: np.sqrt(bx**2 + by**2 + bz**2)),
+    "s": (["t", "beta"], lambda t, beta: t * C * beta),
+    "xprime": (["betax", "beta"], np.divide),
+    "yprime": (["betay", "beta"], np.divide),
+    "zprime": (["betaz", "beta"], np.divide),
+    "F_Bx": (["betay", "Bz", "betaz", "By"], lambda b1, f2, b2, f1: Q*C * (b1*f2 - b2*f1)),
+    "F_By": (["betaz", "Bx", "betax", "Bz"], lambda b1, f2, b2, f1: Q*C * (b1*f2 - b2*f1)),
+    "F_Bz": (["betax", "By", "betay", "Bx"], lambda b1, f2, b2, f1: Q*C * (b1*f2 - b2*f1)),
+    "F_Ex": (["Ex"], lambda e: Q * e),
+    "F_Ey": (["Ey"], lambda e: Q * e),
+    "F_Ez": (["Ez"], lambda e: Q * e),
+    "F_x": (["F_Ex", "F_Bx"], np.add),
+    "F_y": (["F_Ey", "F_By"], np.add),
+    "F_z": (["F_Ez", "F_Bz"], np.add),
+    "absB": (["Bx", "By", "Bz"], lambda x, y, z: np.sqrt(x**2 + y**2 + z**2)),
+    "absE": (["Ex", "Ey", "Ez"], lambda x, y, z: np.sqrt(x**2 + y**2 + z**2)),
+    "unwantedB": (["By", "Bz"], lambda y, z: np.sqrt(y**2 + z**2)),
+    "unwantedE": (["Ex", "Ez"], lambda x, z: np.sqrt(x**2 + z**2)),
+}
+
 
+def select(names):
+    '''Columns of derived table to plot names, id, s and z are always needed for grouping, integrals and plots'''
+    return ["id", "s", "z"] + [name for name in names if name not in ("id", "s", "z")]
 
-def lorentz(field):
-    '''Calculate Lorentz Force from E and B field'''
+
+def lorentz(ids, data, names=COLUMNS):
+    '''Calculate Lorentz Force from E and B field as whole columns, returns table of names x rows.
+    Only quantities names depend on are calculated, so only those raw columns of data are read.'''
+    values = {}
+    def value(name):
+        if name not in values:
+            if name in RAW:
+                values[name] = data[RAW.index(name)]
+            else:
+                depends, function = DERIVED[name]
+                values[name] = function(*[value(d) for d in depends])
+        return values[name]
+    table = np.empty((len(names), len(ids)))
+    for k, name in enumerate(names):
+        table[k] = ids if name == "id" else value(name)
+    return table
+
+
+class Groups:
+    '''Row ranges of each particle in a table sorted by particle ID'''
+    def __init__(self, keys, starts, stops):
+        self.keys = keys
+        self.starts = starts
+        self.stops = stops
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def groupby(table, column=0):
+    '''Sort table by one column (only if out of order) and index the row range of each unique value'''
+    print("Grouping data by column %i ..." % column)
+    values = table[column]
+    if np.any(values[1:] < values[:-1]): # Stable sort keeps order of points along each trajectory
+        table = table[:, np.argsort(values, kind = 'stable')]
+        values = table[column]
+    starts = np.flatnonzero(np.concatenate(([len(values) > 0], values[1:] != values[:-1]))) # Run-length pass
+    stops = np.append(starts[1:], len(values)) if len(starts) else starts
+    return table, Groups(values[starts].astype(np.int64), starts, stops)
+
+
+def prepare(file, skip=SKIP, rebuild=False, names=COLUMNS, growing=False):
+    '''Read, derive columns names and group trajectories of one file'''
+    with STAGES("read") as stage:
+        ids, trace = readcached(file, skip, rebuild, growing)
+        stage["rows"] = len(ids)
     print("Calculating LORENTZ-condition...")
-    q=1
-    c=299792458
-    #         0                1         2         3                                                      7             8             9             10              11
-    lines = [["id", r"s / m", r"x / m", r"y / m", r"z / m", r"$x'$ / rad", r"$y'$ / rad", r"$z'$ / rad", r"$B_x$ / T", r"$B_y$ / T", r"$B_z$ / T", r"$E_x$ / V/m", r"$E_y$ / V/m", r"$E_z$ / V/m", r"$F_{Bx}$ / eV/m", r"$F_{By}$ / eV/m", r"$F_{Bz}$ / eV/m", r"$F_{Ex}$ / eV/m", r"$F_{Ey}$ / eV/m", r"$F_{Ez}$ / eV/m", r"$F_x$ / eV/m", r"$F_y$ / eV/m", r"$F_z$ / eV/m", r"|B| / T", r"|E| / V/m", r"$\sqrt{B_y^2+B_z^2}$ / T", r"$\sqrt{E_x^2+E_z^2}$ / V/m"]]
-    for f in tqdm(field):
-        s = f[13] * c * math.sqrt(f[4]**2 + f[5]**2 + f[6]**2)
-        xprime = f[4] / math.sqrt(f[4]**2 + f[5]**2 + f[6]**2)
-        yprime = f[5] / math.sqrt(f[4]**2 + f[5]**2 + f[6]**2)
-        zprime = f[6] / math.sqrt(f[4]**2 + f[5]**2 + f[6]**2)
-        FBx = q*c * (f[5]*f[9] - f[6]*f[8])
-        FBy = q*c * (f[6]*f[7] - f[4]*f[9])
-        FBz = q*c * (f[4]*f[8] - f[5]*f[7])
-        FEx = q * f[10]
-        FEy = q * f[11]
-        FEz = q * f[12]
-        Fx = FEx + FBx
-        Fy = FEy + FBy
-        Fz = FEz + FBz
-        absB = math.sqrt(f[7]**2 + f[8]**2 + f[9]**2)
-        absE = math.sqrt(f[10]**2 + f[11]**2 + f[12]**2)
-        unwantedB =  math.sqrt(f[8]**2 + f[9]**2)
-        unwantedE =  math.sqrt(f[10]**2 + f[12]**2)
-        line = [f[0], s] + f[1:4] + [xprime, yprime, zprime] + f[7:13] + [FBx, FBy, FBz, FEx, FEy, FEz, Fx, Fy, Fz, absB, absE, unwantedB, unwantedE]
-        lines.append(line)
-    return lines
-
-
-def sort4d(data, column):
-    '''Sort multidimensional data according to one column'''
-    print("Sorting data by column %i ..." % column)
-    dict = {}
-    for key in tqdm(set(l[column] for l in data[1:])): # set generates unsorted list of all unique values in list
-        dict[key] = [data[0]]
-        for line in data[1:]:
-            if key == line[column]:
-                dict[key].append(line)
-    return dict
+    with STAGES("derive", len(ids)):
+        table = lorentz(ids, trace, names)
+    with STAGES("group", len(ids)):
+        return groupby(table, 0)
+
+
+def readspan(args):
+    '''Pool worker: parse a span of a file and save arrays to .npy files, returns their common path prefix'''
+    file, span, skip, tmpdir = args
+    with STAGES("read") as stage:
+        ids, data = readlines(file, skip, span = span)
+        stage["rows"] = len(ids)
+    path = os.path.join(tmpdir, "%s_%i" % (os.path.basename(file), span[0]))
+    np.save(path + "_ids.npy", ids)
+    np.save(path + "_data.npy", data)
+    return path
+
+
+def preparesaved(args):
+    '''Pool worker: prepare one file and save its grouped table to a .npy file, returns path and groups'''
+    file, skip, names, growing, tmpdir = args
+    table, groups = prepare(file, skip, names = names, growing = growing)
+    path = os.path.join(tmpdir, os.path.basename(file) + ".npy")
+    np.save(path, table)
+    return path, groups
+
+
+def preparemany(files, skip=SKIP, rebuild=False, jobs=1, names=COLUMNS, growing=False):
+    '''Read, derive and group trajectories of several files, in a pool of processes if jobs > 1.
+    Workers hand back arrays as memory-mapped .npy files instead of pickling them.'''
+    if jobs <= 1:
+        return [prepare(file, skip, rebuild, names, growing) for file in files]
+    with STAGES("pool") as stage: # Stages inside the worker processes are merged into the ones of this run
+        sorts = preparepool(files, skip, rebuild, jobs, names, growing)
+        stage["rows"] = sum(table.shape[1] for table, groups in sorts)
+    return sorts
+
+
+def preparepool(files, skip, rebuild, jobs, names, growing=False):
+    '''Read, derive and group trajectories of several files in a pool of jobs processes'''
+    tmpdir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmpdir, True)
+    with STAGES.pool(jobs) as pool:
+        # Parse outdated files in spans spread over all processes and assemble their caches
+        todo = [file for file in files if rebuild or loadcache(file, skip, growing) is None]
+        snaps = {file: snapshot(file, growing) for file in todo}
+        tasks = [(file, span, skip, tmpdir) for file in todo for span in splitfile(file, -(-jobs // len(todo)), snaps[file][0])]
+        paths = STAGES.map(pool, readspan, tasks)
+        for file in todo:
+            parts = [path for task, path in zip(tasks, paths) if task[0] == file]
+            writecache(file, skip, [(np.load(path + "_ids.npy", mmap_mode = 'r'), np.load(path + "_data.npy", mmap_mode = 'r')) for path in parts], snap = snaps[file])
+            for path in parts:
+                os.remove(path + "_ids.npy")
+                os.remove(path + "_data.npy")
+        # Derive and group each file from its cache
+        results = STAGES.map(pool, preparesaved, [(file, skip, names, growing, tmpdir) for file in files])
+    return [(np.load(path, mmap_mode = 'r'), groups) for path, groups in results]
 
 
 def matplotlib_init():
     '''Matplotlib settings, so changes to local ~/.config/matplotlib aren't necesarry.'''
+    import matplotlib.pyplot as plt # Only imported when plotting
     plt.rcParams['mathtext.fontset'] = 'stixsans' # Sans-Serif
     plt.rcParams['mathtext.default'] = 'regular' # No italics
     plt.rcParams['axes.formatter.use_mathtext'] = 'True' # MathText on coordinate axes
@@ -112,57 +601,256 @@ def matplotlib_init():
     return
 
 
-def setcolor(axis, cmap, ncolumn):
-    colors = []
-    for i in np.linspace(0., 0.75, ncolumn):
-        colors.append(cmap(i))
-    axis.set_prop_cycle(cycler('color', colors))
-    #axis.set_color_cycle(colors) deprecated
+def interior(groups, n):
+    '''Mask of the n rows of a grouped table that are neither first nor last point of their particle'''
+    mask = np.ones(n, dtype = bool)
+    mask[groups.starts] = False
+    mask[groups.stops - 1] = False
+    return mask
+
+
+def reducetraces(table, groups, columns):
+    '''Exit value and integral over s of columns of a select()ed table for all particles at once, as particles x columns matrices'''
+    outs = np.full((len(groups), len(columns)), np.nan)
+    ints = np.zeros((len(groups), len(columns)))
+    if not len(groups):
+        return outs, ints
+    ds = np.empty(table.shape[1]) # Segmented diff, zero at first and last point of each particle
+    ds[0] = 0.
+    np.subtract(table[1, 1:], table[1, :-1], out = ds[1:])
+    ds[~interior(groups, table.shape[1])] = 0.
+    valid = groups.stops - groups.starts > 2 # At least one point left after excluding first and last
+    last = groups.stops[valid] - 2
+    for k, column in enumerate(columns):
+        ints[:, k] = np.add.reduceat(table[column] * ds, groups.starts)
+        outs[valid, k] = table[column, last]
+    return outs, ints
+
+
+def loadreduced(file, columns):
+    '''Persisted (cache key, particle IDs, outs, ints) of reducefile for columns, None if missing or other columns'''
+    try:
+        with np.load(file + ".cache" + os.sep + "reduced.npz") as stored:
+            names = stored["columns"].tolist()
+            if not set(columns) <= set(names):
+                return None
+            k = [names.index(name) for name in columns]
+            return json.loads(str(stored["key"])), stored["keys"], stored["outs"][:, k], stored["ints"][:, k]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def saveresults(file, columns, results):
+    '''Persist particle IDs, outs and ints of reducefile next to the cache they were calculated from'''
+    key = readkey(file)
+    if key is None: # No cache to append to later
+        return
+    keys, outs, ints = results
+    try:
+        with open(file + ".cache" + os.sep + "reduced.tmp", 'wb') as f:
+            np.savez(f, key = json.dumps(key), columns = np.array(columns), keys = keys, outs = outs, ints = ints)
+        os.replace(file + ".cache" + os.sep + "reduced.tmp", file + ".cache" + os.sep + "reduced.npz")
+    except OSError as err:
+        print("Could not write results to cache: %s" % err)
+
+
+def reducefile(file, columns, skip=SKIP, rebuild=False):
+    '''Exit values and integrals of columns of all particles of one file as particle IDs, outs and ints.
+    Results are persisted next to the cache, when called again only blocks appended to file since then are
+    parsed, derived and reduced and merged into them, assuming one block per particle ID.'''
+    names = select(columns)
+    rows = [names.index(name) for name in columns]
+    key = readkey(file)
+    stored = None if rebuild else loadreduced(file, columns)
+    if stored is not None and stored[0] == key:
+        if iscurrent(key, file, skip, True):
+            print("Reading results from cache %s ..." % (file + ".cache" + os.sep))
+            return stored[1:]
+        with STAGES("read") as stage:
+            appended = appendcache(file, skip)
+            stage["rows"] = len(appended[0]) if appended else 0
+        if appended is not None:
+            ids, data = appended
+            with STAGES("derive", len(ids)):
+                table, groups = groupby(lorentz(ids, data, names))
+            with STAGES("reduce", len(ids)):
+                outs, ints = reducetraces(table, groups, rows)
+            old = np.isin(stored[1], groups.keys)
+            if not len(ids) or np.all(stored[1][old] == ids[0]): # Only the reparsed last block may be known already
+                keys = np.concatenate((stored[1][~old], groups.keys))
+                order = np.argsort(keys, kind = 'stable')
+                results = keys[order], np.concatenate((stored[2][~old], outs))[order], np.concatenate((stored[3][~old], ints))[order]
+                saveresults(file, columns, results)
+                return results
+            print("Particle IDs of %s repeat in appended blocks, reducing all ..." % file)
+    table, groups = prepare(file, skip, rebuild, names, True)
+    with STAGES("reduce", table.shape[1]):
+        results = (groups.keys,) + reducetraces(table, groups, rows)
+    saveresults(file, columns, results)
+    return results
+
+
+class RunningStats:
+    '''Online mean and standard deviation of rows of values (Welford's algorithm)'''
+    def __init__(self, ncolumn):
+        self.n = 0
+        self.mean = np.zeros(ncolumn)
+        self.m2 = np.zeros(ncolumn)
+
+    def add(self, values):
+        self.n += 1
+        delta = values - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (values - self.mean)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.n) if self.n else np.full(len(self.m2), np.nan)
+
+
+def streamstats(file, columns, skip=SKIP):
+    '''Exit value and integral statistics of columns names, derived particle by particle without holding the file'''
+    outs = RunningStats(len(columns))
+    ints = RunningStats(len(columns))
+    names = select(columns)
+    rows = [names.index(name) for name in columns]
+    for id, data in readblocks(file, skip):
+        table = lorentz(np.full(data.shape[1], id), data, names)
+        out, integral = reducetraces(table, Groups(np.array([id]), np.array([0]), np.array([table.shape[1]])), rows)
+        outs.add(out[0])
+        ints.add(integral[0])
+    return outs, ints
+
+
+def plotcolumn(ax, x, y, counts, cmap):
+    '''Plot trajectories of all particles of a phase as one LineCollection, particle i of n colored cmap(0.75 i / n).
+    x and y hold the points of all particles one after another, counts the number of points of each.'''
+    from matplotlib.collections import LineCollection
+    segments = np.split(np.column_stack((x, y)), np.cumsum(counts)[:-1])
+    ax.add_collection(LineCollection(segments, colors = cmap(np.linspace(0., 0.75, len(counts))), linewidths = .5, alpha = 0.7))
+    ax.autoscale_view()
+    ax.set_xlim(-1., 1.)
     return
 
 
-def sumtrace(data, column):
-    x = data[0][2]
-    y = data[0][3]
-    z = data[0][4]
-    s = data[0][1]
-    lsum = 0.
-    fsum = 0.
-    llist = []
-    zlist = []
-    fieldlist = []
-    sumlist = []
-    for line in data[1:-1]:
-        dx = line[2] - x
-        x = line[2]
-        dy = line[3] - y
-        y = line[3]
-        dz = line[4] - z
-        z = line[4]
-        ds = line[1] - s
-        s = line[1]
-        dl = ds#math.sqrt(dx**2+dy**2+dz**2)
-        fdl = line[column] * ds#dl
-        lsum = lsum + dl
-        fsum = fsum + fdl
-        #if line[column] == 0.:
-        #    print("Recheck particle:", line[0])
-        fieldlist.append(line[column])
-        zlist.append(z)
-        llist.append(lsum)
-        sumlist.append(fsum)
-    return zlist, llist, fieldlist, sumlist
-        
-
-def plotcolumn(data, column, name):
-    x, s, y, inty = sumtrace(data, column)
-    ax.plot(x, y, linewidth=.5, alpha = 0.7)
-    ax.set_xlabel(r"s / m")#= \sum_i c \left|\vec\beta_i\right| t_i$ / m") #\sqrt{x_i^2+y_i^2+z_i^2}
-    ax.set_ylabel(name.split(", ")[0])
-    ax.autoscale()                      
-#    xmin, xmax = ax.get_xlim()
-    ax.set_xlim(-1., 1.)#x[0], x[-1])
-    return y[-1], inty[-1]
+DENSITYBINS = (400, 300) # bins in s and value of density images
+
+
+def densityextent(sorts, column):
+    '''Common s and value range of one column of a select()ed table over all phases for density images'''
+    low, high = np.inf, -np.inf
+    for table, groups in sorts:
+        values = table[column, interior(groups, table.shape[1])]
+        if len(values):
+            low, high = min(low, np.nanmin(values)), max(high, np.nanmax(values))
+    if not low < high: # Constant or no values
+        low, high = (low - 0.5, high + 0.5) if np.isfinite(low) else (-0.5, 0.5)
+    return (-1., 1.), (low, high)
+
+
+def densitycolumn(ax, x, y, cmap, extent):
+    '''Histogram points of all particles of a phase in s and value and show them as one image,
+    so render time and file size do not depend on the number of particles'''
+    from matplotlib.colors import LogNorm
+    density, xedges, yedges = np.histogram2d(x, y, bins = DENSITYBINS, range = extent)
+    if density.any():
+        ax.imshow(np.ma.masked_equal(density.T, 0), origin = 'lower', extent = extent[0] + extent[1], aspect = 'auto', interpolation = 'nearest', cmap = cmap, norm = LogNorm(0.3, density.max()), alpha = 0.7) # Single counts stay visible
+    ax.set_xlim(extent[0])
+    ax.set_ylim(extent[1])
+    return
+
+
+def splitlabel(label):
+    '''Split axis label into quantity and unit'''
+    try:
+        name = label.split(" / ")[0]
+        unit = label.split(" / ")[1]
+    except IndexError:
+        name = label
+        unit = ""
+    return name, unit
+
+
+def printstats(name, unit, outavg, outsigma, intavg, intsigma):
+    '''Print average and standard deviation of exit values and integrals'''
+    print("%s = %s %s; " % (name, outavg, unit) + "sigma(%s) = %s %s" %(name, outsigma, unit))
+    print("%s dl = %s %s; " % (name, intavg, unit) + "sigma(%s dl) = %s %s" %(name, intsigma, unit))
+
+
+def writestats(file, columns, phases, stats):
+    '''Write average, standard deviation and number of particles per column and phase as file.csv and file.json,
+    stats holds (exit averages, exit sigmas, integral averages, integral sigmas, particles) of each phase'''
+    table = []
+    for k, column in enumerate(columns):
+        for phase, (outavg, outsigma, intavg, intsigma, n) in zip(phases, stats):
+            table.append({"column": column, "phase": phase, "mean": float(outavg[k]), "std": float(outsigma[k]),
+                          "int_mean": float(intavg[k]), "int_std": float(intsigma[k]), "n_particles": int(n)})
+    with open(file + ".csv", 'w', newline = "") as f:
+        writer = csv.DictWriter(f, fieldnames = list(table[0].keys()) if table else ["column"])
+        writer.writeheader()
+        writer.writerows(table)
+    with open(file + ".json", 'w') as f:
+        json.dump(table, f, indent = 1)
+    print("Statistics written to %s.csv and %s.json" % (file, file))
+
+
+def figuretask(sorts, reduced, k, column, row, file, density=False):
+    '''Collect plotted points, legend and statistics of one column of all phases for renderfigure'''
+    fullname = LABELS[COLUMNS.index(column)]
+    name, unit = splitlabel(fullname)
+    phases = []
+    names = []
+    for n, ((table, groups), (outs, ints)) in enumerate(zip(sorts, reduced)):
+        print("Plotting %s ..." % name)
+        mask = interior(groups, table.shape[1]) # First and last point of each particle are not plotted
+        phases.append((table[2, mask], table[row, mask], np.maximum(groups.stops - groups.starts - 2, 0)))
+        outavg, outsigma, stroutavg, stroutsigma = mean(outs[:, k])
+        intavg, intsigma, strintavg, strintsigma = mean(ints[:, k])
+        printstats(name, unit, outavg, outsigma, intavg, intsigma)
+
+        '''Legend'''
+        phi = n
+        if n == 3:
+            phi = 7
+        if COLUMNS.index(column) > 7:
+            names.append(r"%s at $\phi = \frac{%d \pi}{4}$" % (name, phi))
+        else:
+            names.append(r"%s$_{out}$ = %s %s" % (name, stroutavg, unit) + r" at $\phi = \frac{%d \pi}{4}$" % phi + "\n" + r"$\sigma$(%s$_{out}$) = %s %s" %(name, stroutsigma, unit))
+    return {"label": fullname, "phases": phases, "names": names, "file": file, "density": density,
+            "extent": densityextent(sorts, row) if density else None}
+
+
+def renderfigure(task):
+    '''Draw one figure of a figuretask once with Agg, save PNG from the drawn pixels and PDF, returns file name base.
+    Pool worker: uses no pyplot state, so figures can be rendered in parallel processes.'''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import matplotlib.image as image
+    import matplotlib.lines as lines
+    from matplotlib import cm
+    matplotlib_init()
+    cmaps = [cm.Reds, cm.Purples, cm.Blues, cm.Greens]
+    f = Figure()
+    canvas = FigureCanvasAgg(f)
+    ax = f.add_subplot(111)
+    with STAGES("render", sum(len(x) for x, y, counts in task["phases"])):
+        for n, (x, y, counts) in enumerate(task["phases"]):
+            if task["density"]:
+                densitycolumn(ax, x, y, cmaps[n], task["extent"])
+            else:
+                plotcolumn(ax, x, y, counts, cmaps[n])
+        ax.set_xlabel(r"s / m")#= \sum_i c \left|\vec\beta_i\right| t_i$ / m") #\sqrt{x_i^2+y_i^2+z_i^2}
+        ax.set_ylabel(task["label"].split(", ")[0])
+        ax.legend([lines.Line2D([], [], c = cmaps[n](0.5), ls = '-') for n in range(len(task["phases"]))], task["names"], loc = 0)
+        f.tight_layout()
+        f.patch.set_facecolor('none') # Transparent like savefig.transparent
+        ax.patch.set_facecolor('none')
+        canvas.draw()
+    with STAGES("savefig_png"):
+        image.imsave(task["file"] + ".png", np.asarray(canvas.buffer_rgba()), dpi = f.dpi)
+    with STAGES("savefig_pdf"):
+        f.savefig(task["file"] + ".pdf")
+    return task["file"]
 
 
 def mean(list):
@@ -185,8 +873,17 @@ def mean(list):
 def main(argv):
     '''read in CMD arguments'''
     fame = "refpart"
+    rebuild = False
+    jobs = 1
+    stream = False
+    update = False
+    statsonly = False
+    density = False
+    report = None
+    profiled = None
+    columns = ["x", "y", "xprime", "yprime", "Bx", "By", "Bz", "Ex", "Ey", "Ez", "F_x", "F_y", "F_z", "absB", "absE", "unwantedB", "unwantedE"] # columns to plot
     try:                                
-        opts, args = getopt.getopt(argv, "hi:ls")
+        opts, args = getopt.getopt(argv, "hi:lsrj:c:p:u", ["rebuild", "jobs=", "stream", "update", "columns=", "profile=", "cprofile=", "stats-only", "density"])
     except getopt.GetoptError as err:
         print(str(err) + "\n")
         usage()                      
@@ -197,78 +894,85 @@ def main(argv):
             sys.exit()
         elif opt == "-i":
             fname = arg
+        elif opt in ("-r", "--rebuild"):
+            rebuild = True
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt == "--stream":
+            stream = True
+        elif opt in ("-u", "--update"):
+            update = True
+        elif opt == "--stats-only":
+            statsonly = True
+        elif opt == "--density":
+            density = True
+        elif opt in ("-p", "--profile"):
+            report = arg
+        elif opt == "--cprofile":
+            profiled = arg
+        elif opt in ("-c", "--columns"):
+            columns = arg.split(",")
+            for column in columns:
+                if column not in COLUMNS:
+                    print("Unknown column %s, choose from %s\n" % (column, ",".join(COLUMNS)))
+                    usage()
+                    sys.exit(2)
+
+    if report:
+        STAGES.enable(profiled)
+        atexit.register(STAGES.write, report, argv)
+
+    '''Select which columns to derive'''
+    derived = select(columns)
+    rows = [derived.index(column) for column in columns]
 
     '''Get data''' 
     ifile = "." + os.sep + fname
-    sorts = []
-    for i in [0, 1, 2, 7]:
-        trace = readlines(ifile + "_%s-pi-quarter_small_trajectory.dat" % i)
-        field = lorentz(trace)
-        sort = sort4d(field, 0)
-        sorts.append(sort)
-        
-    '''Plot setup'''
+    phases = [0, 1, 2, 7]
+    files = [ifile + "_%s-pi-quarter_small_trajectory.dat" % i for i in phases]
     odir = "." + os.sep + fname + os.sep #"matplotlib"
     if not os.path.exists(odir): 
         os.makedirs(odir)
-    matplotlib_init()
-    
-    '''Select which columns to plot'''
-    for j in [2, 3, 5, 6, 8, 9, 10, 11, 12, 13, 20, 21, 22, 23, 24, 25, 26]:
-        global f, ax
-        f = plt.figure()
-        ax = f.add_subplot(111)
-        cmaps = [cm.Reds, cm.Purples, cm.Blues, cm.Greens]
-        ls = []
-        names = []
-        for n, sort in enumerate(sorts):
-            setcolor(ax, cmaps[n], len(sorts[n].keys()))
-            
-            '''Get column names'''
-            fullname = sorts[n][1][0][j]
-            try:
-                name = fullname.split(" / ")[0]
-                unit = fullname.split(" / ")[1]
-            except IndexError:
-                name = fullname
-                unit = ""
-
-            '''Plot data'''
-            youts = []
-            yints = []
-            print("Plotting %s ..." % name)
-            for key in tqdm(sorts[n].keys()):
-                yout, yint = plotcolumn(sorts[n][key][1:], j, fullname)
-                youts.append(yout)
-                yints.append(yint)
-            outavg, outsigma, stroutavg, stroutsigma = mean(youts)
-            intavg, intsigma, strintavg, strintsigma = mean(yints)
-            print("%s = %s %s; " % (name, outavg, unit) + "sigma(%s) = %s %s" %(name, outsigma, unit))
-            print("%s dl = %s %s; " % (name, intavg, unit) + "sigma(%s dl) = %s %s" %(name, intsigma, unit))
-
-            '''Legend'''
-            ls.append(lines.Line2D([], [], c = cmaps[n](0.5), ls = '-'))
-            phi = n
-            if n == 3:
-                phi = 7
-            if j > 7:
-                names.append(r"%s at $\phi = \frac{%d \pi}{4}$" % (name, phi))
-            else:
-                names.append(r"%s$_{out}$ = %s %s" % (name, stroutavg, unit) + r" at $\phi = \frac{%d \pi}{4}$" % phi + "\n" + r"$\sigma$(%s$_{out}$) = %s %s" %(name, stroutsigma, unit))
-
-        ax.legend(ls, names, loc = 0)
-                        
-        plt.tight_layout()
-        plt.draw()
-        #plt.show()
-        
-        '''Save plot'''                
-        for c in ["$", "\mathcal", "}", "{", "|", "^", "\\", "_"]:
-            name = name.replace(c, "")
-        name = name.replace("^'", "prime") + "_trace"
-        plt.savefig(odir + fname + "_" + name + ".pdf")
-        plt.savefig(odir + fname + "_" + name + ".png")
-        plt.close('all')
+    if stream: # Statistics only, one particle in memory at a time
+        with STAGES("stream"):
+            streamed = [streamstats(file, columns) for file in files]
+        stats = [(outs.mean, outs.std, ints.mean, ints.std, outs.n) for outs, ints in streamed]
+    elif update: # Exit values and path integrals of appended particles merged into earlier results
+        reduced = [reducefile(file, columns, rebuild = rebuild)[1:] for file in files]
+        if not statsonly:
+            sorts = preparemany(files, jobs = jobs, names = derived, growing = True)
+    else:
+        sorts = preparemany(files, rebuild = rebuild, jobs = jobs, names = derived)
+
+        '''Exit values and path integrals of all particles per phase'''
+        with STAGES("reduce", sum(table.shape[1] for table, groups in sorts)):
+            reduced = [reducetraces(table, groups, rows) for table, groups in sorts]
+    if not stream:
+        stats = [(np.mean(outs, axis = 0), np.std(outs, axis = 0), np.mean(ints, axis = 0), np.std(ints, axis = 0), len(outs)) for outs, ints in reduced]
+    if stream or statsonly: # Never import matplotlib
+        for k, column in enumerate(columns):
+            name, unit = splitlabel(LABELS[COLUMNS.index(column)])
+            for outavg, outsigma, intavg, intsigma, n in stats:
+                printstats(name, unit, outavg[k], outsigma[k], intavg[k], intsigma[k])
+        writestats(odir + fname + "_stats", columns, phases, stats)
+        return
+
+    '''Render figures, several at once in a pool of processes if jobs > 1'''
+    def tasks(batch):
+        for k, (column, j) in batch:
+            name = splitlabel(LABELS[COLUMNS.index(column)])[0]
+            for c in ["$", "\\mathcal", "}", "{", "|", "^", "\\", "_"]:
+                name = name.replace(c, "")
+            name = name.replace("^'", "prime") + ("_density" if density else "_trace")
+            yield figuretask(sorts, reduced, k, column, j, odir + fname + "_" + name, density)
+    figures = list(enumerate(zip(columns, rows)))
+    if jobs <= 1:
+        for task in tasks(figures):
+            renderfigure(task)
+    else:
+        with STAGES.pool(jobs) as pool:
+            for n in range(0, len(figures), jobs): # Batches bound the memory of collected points
+                STAGES.map(pool, renderfigure, list(tasks(figures[n:n + jobs])))
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Benchmark the live plotters plottest_v*.py headless on their synthetic feeds at fixed rates
+'''
+import getopt, json, os, platform, subprocess, sys, tempfile, time
+import matplotlib
+import numpy as np
+from benchtest import commit
+
+MONITORS = {"plottest_v1.py": [10., 1000.], "plottest_v2.py": [10., 1000.], "plottest_v3.py": [1., 10.],
+            "plottest_v4.py": [1., 10.], "plottest_v5.py": [10., 1000.]} # samples per second to feed
+
+
+def usage():
+    '''Usage function'''
+    print("""Frame times, latency and dropped samples of the live plotters drawing with Agg at fixed input rates
+
+Usage: %s -h -m [monitors] -f [frames] -o [output] -b [baseline] -t [tolerance]
+
+-h                  Show this help message and exit
+-m [monitors]       Comma separated plotters and rates, e.g. plottest_v2.py:10:1000, default all
+-f [frames]         Frames to draw per run, default 30
+-o [output]         JSON file to store results in, default plotbench.json
+-b [baseline]       JSON file of an earlier run to compare frame and draw times with
+-t [tolerance]      Exit with status 1 if a p95 time exceeds tolerance times the baseline, default 1.5
+""" %sys.argv[0])
+
+
+def run(monitor, rate, frames):
+    '''Run one plotter for frames at rate, return its FrameStats summed over all reports, percentiles of the last'''
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file = os.path.join(tmpdir, "stats.jsonl")
+        wall = time.perf_counter()
+        process = subprocess.run([sys.executable, monitor, "--rate", str(rate), "--frames", str(frames), "--stats", file],
+                                 cwd = os.path.dirname(os.path.abspath(__file__)), env = dict(os.environ, MPLBACKEND = "Agg"),
+                                 stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+        wall = time.perf_counter() - wall
+        if process.returncode or not os.path.exists(file):
+            print("%s failed:\n%s" % (monitor, process.stderr.decode()[-2000:]))
+            return None
+        with open(file, 'r') as f:
+            reports = [json.loads(line) for line in f]
+    result = dict(reports[-1], monitor = monitor, rate = rate, wall = wall)
+    for key in ("frames", "samples", "coalesced", "dropped"):
+        result[key] = sum(report[key] for report in reports)
+    result["fps"] = result["frames"] / sum(report["frames"] / report["fps"] for report in reports if report["fps"])
+    print("%-15s %7g/s %6.1f fps  frame %s  draw %s  latency %s ms  %i dropped" % (monitor, rate, result["fps"],
+          *["%7.1f" % result[key]["p95"] if result.get(key) else "    -  " for key in ("frame", "draw", "latency")], result["dropped"]))
+    return result
+
+
+def compare(results, baseline, tolerance):
+    '''Print p95 frame and draw times relative to a baseline run, return the number that exceed tolerance times it'''
+    old = {(r["monitor"], r["rate"]): r for r in baseline["results"]}
+    print("\nCompared to %s (p95):" % baseline.get("commit"))
+    regressions = 0
+    for r in results:
+        b = old.get((r["monitor"], r["rate"]))
+        if not b:
+            continue
+        ratios = {key: r[key]["p95"] / b[key]["p95"] for key in ("frame", "draw") if r.get(key) and b.get(key) and b[key]["p95"]}
+        slower = [key for key in ratios if ratios[key] > tolerance]
+        regressions += len(slower)
+        print("%-15s %7g/s: %s%s" % (r["monitor"], r["rate"], ", ".join("%.2fx %s time" % (ratios[key], key) for key in ratios),
+                                      "  REGRESSION" if slower else ""))
+    return regressions
+
+
+def main(argv):
+    '''read in CMD arguments'''
+    monitors = MONITORS
+    frames = 30
+    output = "plotbench.json"
+    baseline = None
+    tolerance = 1.5
+    try:
+        opts, args = getopt.getopt(argv, "hm:f:o:b:t:")
+    except getopt.GetoptError as err:
+        print(str(err) + "\n")
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt == "-m":
+            monitors = {}
+            for monitor in arg.split(","):
+                name, *rates = monitor.split(":")
+                monitors[name] = [float(rate) for rate in rates] or MONITORS[name]
+        elif opt == "-f":
+            frames = int(arg)
+        elif opt == "-o":
+            output = arg
+        elif opt == "-b":
+            baseline = arg
+        elif opt == "-t":
+            tolerance = float(arg)
+
+    results = []
+    for monitor, rates in monitors.items():
+        for rate in rates:
+            result = run(monitor, rate, frames)
+            if result:
+                results.append(result)
+    report = {"commit": commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "numpy": np.__version__, "matplotlib": matplotlib.__version__, "machine": platform.machine(),
+              "cpus": os.cpu_count(), "frames": frames, "results": results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent = 1)
+    print("Results written to %s" % output)
+    failed = sum(len(rates) for rates in monitors.values()) - len(results)
+    if baseline:
+        with open(baseline, 'r') as f:
+            failed += compare(results, json.load(f), tolerance)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
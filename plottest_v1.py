@@ -2,21 +2,22 @@
 '''
 dynamic plotting with python matpltolib
 '''
-import time, datetime as dt
+import sys, time
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from plottools import Acquisition, FrameStats, Pyramid, began, datenums, feed, options, paced
 
 nmax = 101
 readout = 0.1
-start = time.time()
+rate, frames, statsfile, overlay, recording = options(sys.argv[1:]) # random readout intervals unless --rate, endless unless --frames
+stats = FrameStats("plottest_v1", statsfile)
+start = began(**recording) # now, or the first replayed sample
 timestamps = [start - readout * (nmax - i) for i in range(nmax)]
-dates = [dt.datetime.fromtimestamp(t) for t in timestamps]
-datenums = [mdates.date2num(d) for d in dates]
+times = datenums(timestamps)
 
-x = datenums
-y = [[0] * nmax, [1] * nmax]
-yerr = [[0.0001] * nmax, [0.0001] * nmax]
+history = Pyramid(columns = 2) # all samples of both timelines, and their minima and maxima over longer times
+initial = np.column_stack((np.zeros(nmax), np.ones(nmax)))
+history.extend(times, initial)
 
 plt.ion()
 f, axarr = plt.subplots(2, 1, sharex='col')
@@ -29,21 +30,51 @@ l = [0]*len(axarr)
 cap = [0]*len(axarr)
 bar = [0]*len(axarr)
 for i, ax in enumerate(axarr):
-    l[i], = ax.plot_date(x, y[i], 'r+', label = r"$y = (t - t_0) \cdot (1 + \frac{%s}{10} \cdot \mathrm{random}[-1,1])$" %i)
+    l[i], = ax.plot(times, initial[:, i], 'r+', label = r"$y = (t - t_0) \cdot (1 + \frac{%s}{10} \cdot \mathrm{random}[-1,1])$" %i)
+    ax.xaxis_date()
     ax.legend()
     ax.set_ylabel("Data %s / Unit" %i)
+if overlay:
+    stats.overlay(axarr[0])
 
-while True:
-    x.append(mdates.date2num(dt.datetime.fromtimestamp(time.time())))
-    del x[0]
+def readdata():
+    '''Acquisition source: random numbers of all timelines, read out every 1 to 2 readout periods unless paced'''
+    if not rate:
+        time.sleep(readout * (np.random.random() + 1))
+    return np.random.random(len(axarr))
+
+def showhistory():
+    '''Set the points of the history level that has about one bin per pixel in the shown time range, all of
+    it unless zoomed in, each bin as its minimum and maximum'''
+    ax = axarr[0]
+    xlim = (-np.inf, np.inf) if ax.get_autoscalex_on() else ax.get_xlim()
+    first, last, low, high = history.view(*xlim, bins = int(ax.bbox.width))
+    if history.level: # min at the start, max at the end of the bin
+        x, y = np.column_stack((first, last)).ravel(), np.stack((low, high), axis = 1).reshape(-1, len(axarr))
+    else:
+        x, y = first, low
     for i, ax in enumerate(axarr):
-        y[i].append((x[-1] - x[0]) * (1 + i * 0.1 * np.random.random()))
-        del y[i][0]
-        yerr[i].append(0.1 * y[i][0] + 0.05 * y[i][-1])
-        del yerr[i][0]
-        l[i].set_data(x, y[i])
+        l[i].set_data(x, y[:, i])
         ax.relim()
         ax.autoscale_view()
-    plt.draw()
-    plt.pause(readout/10)
-    time.sleep(readout * (np.random.random() + 1))
+
+acquisition = Acquisition(feed(paced(readdata, rate) if rate else readdata, **recording)) # reads in the background, not held up by drawing
+acquisition.start()
+shown = None
+while frames is None or stats.frames < frames:
+    samples = acquisition.drain() # all readouts since the last frame
+    stats.received(samples, acquisition.arrived)
+    if samples:
+        x = datenums([received for received, random in samples])
+        random = np.array([random for received, random in samples])
+        history.extend(x, (x - times[0])[:, np.newaxis] * (1 + np.arange(len(axarr)) * 0.1 * random))
+    if samples or axarr[0].get_xlim() != shown: # new data or zoomed
+        with stats.timer("scale"):
+            showhistory()
+        with stats.timer("draw"):
+            f.canvas.draw()
+        stats.frame(acquisition.dropped)
+        shown = axarr[0].get_xlim()
+    plt.pause(readout/10) # fixed frame rate
+stats.report()
+acquisition.stop()
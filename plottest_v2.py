@@ -11,29 +11,57 @@ import sys, math, time, datetime as dt
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from plottools import Acquisition, FrameStats, Pyramid, began, datenums, feed, limits, options, paced
 
 def set_errdata(line, caplines, barlinecols, x, xerr, y, yerr):
-    x = np.array(x)
-    xerr = np.array(xerr)
-    y = np.array(y)
-    yerr = np.array(yerr)
+    x = np.asarray(x) # Views are not copied
+    xerr = np.asarray(xerr)
+    y = np.asarray(y)
+    yerr = np.asarray(yerr)
     line.set_data(x, y)
     errpos = (x-xerr,y), (x+xerr,y), (x, y - yerr), (x, y + yerr)
-    for i, pos in enumerate(errpos):
-        caplines[i].set_data(pos)
-    barlinecols[0].set_segments(zip(zip(x-xerr,y), zip(x+xerr,y)))
-    barlinecols[1].set_segments(zip(zip(x,y-yerr), zip(x,y+yerr)))
+    for capline, pos in zip(caplines, errpos): # No caplines without capsize
+        capline.set_data(pos)
+    for bars, segments in zip(barlinecols, (errsegments(x - xerr, y, x + xerr, y), errsegments(x, y - yerr, x, y + yerr))):
+        if hasattr(bars, "set_segments"): # LineCollection
+            bars.set_segments(segments[:, :2])
+        else: # Line2D
+            bars.set_data(segments[:, :, 0].ravel(), segments[:, :, 1].ravel())
     return (line, caplines, barlinecols)
+
+def errsegments(x0, y0, x1, y1):
+    '''Error bars from (x0, y0) to (x1, y1) as one n x 3 x (x, y) array, the third point of each is NaN
+    so the array can also be drawn as one interrupted line'''
+    segments = np.empty((len(x0), 3, 2))
+    segments[:, 0, 0] = x0
+    segments[:, 0, 1] = y0
+    segments[:, 1, 0] = x1
+    segments[:, 1, 1] = y1
+    segments[:, 2] = np.nan
+    return segments
+
+def ondraw(event):
+    '''Cache axes backgrounds without the animated artists after every full draw, e.g. rescaling or resizing'''
+    global bg
+    bg = [f.canvas.copy_from_bbox(ax.bbox) for ax in axarr]
+    blitplot()
+
+def blitplot():
+    '''Restore cached backgrounds and draw only the changing line, cap and bar artists on top'''
+    for i, ax in enumerate(axarr):
+        f.canvas.restore_region(bg[i])
+        for artist in [l[i]] + list(c[i]) + list(b[i]) + ([stats.text] if stats.text and i == 0 else []):
+            ax.draw_artist(artist)
+        f.canvas.blit(ax.bbox)
     
 def createplot(p, n, u):
-    global start, x, xerr, y, yerr, f, axarr, l, c, b    
-    start = time.time()
+    global start, history, f, axarr, l, c, b    
+    start = began(**recording) # now, or the first replayed sample
     timestamps = [start - u * (n - i) for i in range(n)]
-    x = [mdates.date2num(dt.datetime.fromtimestamp(t)) for t in timestamps]
+    x = np.array([mdates.date2num(dt.datetime.fromtimestamp(t)) for t in timestamps])
     start = x[0]
-    xerr = [0] * n
-    y = []
-    yerr = []
+    history = Pyramid(columns = 2 * p) # y - yerr of all plots, then y + yerr
+    history.extend(x, np.zeros((n, 2 * p)))
     l = [0] * p
     c = [0] * p
     b = [0] * p
@@ -41,42 +69,111 @@ def createplot(p, n, u):
     plt.ion()
     #plt.rcParams['text.usetex'] = True
     plt.rcParams['font.size'] = 12
-    plt.rcParams['savefig.extension'] = 'pdf'
+    plt.rcParams['savefig.format'] = 'pdf'
     f, axarr = plt.subplots(p, 1, sharex='col')
     f.suptitle(r"$\mathrm{Timelines}$")
     plt.xticks(rotation=25 )
     plt.xlabel(r"$t\, /\, \mathrm{s}$")
     plt.subplots_adjust(bottom=0.15)
     for i, ax in enumerate(axarr):
-        y.append([0] * n)
-        yerr.append([0] * n)        
-        l[i], c[i], b[i] = ax.errorbar(x, y[i], yerr = yerr[i], xerr = xerr, fmt='r+', label = r"$y \propto \sin(x)^{%s + 1}$" %i)
+        l[i], c[i], b[i] = ax.errorbar(x, np.zeros(n), yerr = np.zeros(n), xerr = np.zeros(n), fmt='r+', label = r"$y \propto \sin(x)^{%s + 1}$" %i)
         ax.legend()
         ax.set_ylabel(r"$\mathrm{Data}\, %s\, /\, \mathrm{Unit}$" %i)
         ax.xaxis.set_major_formatter(mdates.DateFormatter(r'$%H:%M:%S$'))
+        if blit:
+            collections = b[i] # Bars as one NaN interrupted line each, LineCollections create one Path per bar on every update
+            b[i] = [ax.plot([], [], c = bars.get_colors()[0], lw = bars.get_linewidths()[0])[0] for bars in collections]
+            for bars in collections:
+                bars.remove()
+            set_errdata(l[i], c[i], b[i], x, np.zeros(n), np.zeros(n), np.zeros(n))
+            for artist in [l[i]] + list(c[i]) + list(b[i]): # Drawn by blitplot only
+                artist.set_animated(True)
+    if blit:
+        f.canvas.mpl_connect('draw_event', ondraw)
     plt.draw()
     
 def updateplot(u):
-    x.append(mdates.date2num(dt.datetime.fromtimestamp(time.time())))
-    del x[0]
+    global shown
+    samples = acquisition.drain() # all readouts since the last frame, added at once
+    stats.received(samples, acquisition.arrived)
+    if samples:
+        values = np.array([data for received, data in samples])
+        errors = np.abs(0.05 * values)
+        history.extend(datenums([received for received, data in samples]), np.hstack((values - errors, values + errors)))
+    zoomed = not axarr[0].get_autoscalex_on() # by the toolbar
+    if not samples and not (zoomed and axarr[0].get_xlim() != shown): # Nothing new to draw
+        wait(u)
+        return
+    # One cross per bin of the history level matching the shown time range, spanning its time and all values
+    # with their errors, so peaks show at any zoom. These are the samples themselves when zoomed in enough.
+    xlim = axarr[0].get_xlim() if zoomed else (-np.inf, np.inf)
+    first, last, low, high = history.view(*xlim, bins = int(axarr[0].bbox.width) // 2)
+    x = (first + last) / 2
+    xerr = (last - first) / 2
+    lower = low[:, :len(axarr)]
+    upper = high[:, len(axarr):]
     for i, ax in enumerate(axarr):
-        y[i].append(100*(i+1) * math.sin(10000 * (x[-1]-start))**(1+i))
-        del y[i][0]
-        yerr[i].append(0.05 * y[i][-1])
-        del yerr[i][0]
-        set_errdata(l[i], c[i], b[i], x, xerr ,y[i], yerr[i])
-        ax.relim()
-        ax.autoscale_view()
+        set_errdata(l[i], c[i], b[i], x, xerr, (lower[:, i] + upper[:, i]) / 2, (upper[:, i] - lower[:, i]) / 2)
+        if not blit:
+            with stats.timer("scale"):
+                ax.relim()
+                ax.autoscale_view()
         #print(i, mdates.num2date(x[0]), mdates.num2date(x[-1]), y[i][-1])
-    plt.draw()
-    plt.pause(u)
+    if not blit:
+        with stats.timer("draw"):
+            f.canvas.draw()
+        stats.frame(acquisition.dropped)
+        shown = axarr[0].get_xlim()
+        plt.pause(u)
+        return
+    rescaled = False
+    with stats.timer("scale"):
+        xlim = None if zoomed else limits(first[0], last[-1], axarr[0].get_xlim(), (0., 0.2)) # Shared by all panels, room for new points
+        if xlim:
+            axarr[0].set_xlim(xlim, auto = None) # stays autoscaled unless zoomed
+            rescaled = True
+        for i, ax in enumerate(axarr):
+            ylim = limits(lower[:, i].min(), upper[:, i].max(), ax.get_ylim(), (0.1, 0.1)) if len(x) else None # None if zoomed into a gap
+            if ylim:
+                ax.set_ylim(ylim)
+                rescaled = True
+    with stats.timer("draw"):
+        if rescaled:
+            f.canvas.draw() # Full redraw, ondraw caches new backgrounds
+        else:
+            blitplot()
+    stats.frame(acquisition.dropped)
+    shown = axarr[0].get_xlim()
+    wait(u)
+
+def wait(u):
+    '''Handle GUI events until the next frame is due, without the full redraw of plt.pause'''
+    f.canvas.flush_events()
+    if u > 0:
+        f.canvas.start_event_loop(u)
     
+def readdata():
+    '''Acquisition source: one value of each timeline'''
+    t = mdates.date2num(dt.datetime.fromtimestamp(time.time()))
+    return [100*(i+1) * math.sin(10000 * (t-start))**(1+i) for i in range(plots)]
+
 plots = 5
 npoints = 201
 updinterv = 0.1    
+rate, frames, statsfile, overlay, recording = options(sys.argv[1:], rate = 10.) # readouts per second, independent of the frame rate 1 / updinterv
+blit = True # Redraw only data artists on cached backgrounds, rescale axes only when data leaves them
+bg = []
+shown = None # x-limits of the last frame
+stats = FrameStats("plottest_v2", statsfile)
 createplot(plots, npoints, updinterv)
+if overlay:
+    stats.overlay(axarr[0]).set_animated(blit)
+acquisition = Acquisition(feed(paced(readdata, rate), **recording)) # reads in the background, not held up by drawing
+acquisition.start()
 try:
-    while True:
+    while frames is None or stats.frames < frames:
         updateplot(updinterv)
 except (KeyboardInterrupt):
     sys.exit(0)
+stats.report()
+acquisition.stop()
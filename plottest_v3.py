@@ -11,39 +11,70 @@ import sys, math, time, datetime as dt
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from plottools import Acquisition, FrameStats, LorentzFitter, RingBuffer, Waterfall, feed, lorentzian, options, paced
 
-def lorentz(x, xpeak, fwhm):
-    return 1 / (math.pi * fwhm /2 * (1 +((x - xpeak) * 2 / fwhm)**2))
-    
 def createplot(traces, npoints, n0, nmax):
-    x = [n0 + n * (nmax - n0) / npoints for n in range(npoints)]
-    y = [[0] * npoints]
+    global ax, fitline, fittext, waterfall
+    x = n0 + np.arange(npoints) * (nmax - n0) / npoints
+    if history: # past spectra in the waterfall instead of grey lines
+        traces = 0
+    y = RingBuffer(traces + 1, shape = (npoints,), fill = 0) # latest spectra, oldest first
     plt.ion()
     #plt.rcParams['text.usetex'] = True
     #plt.rcParams['font.size'] = 12
-    plt.rcParams['savefig.extension'] = 'pdf'
+    plt.rcParams['savefig.format'] = 'pdf'
+    if history:
+        f, (ax, wax) = plt.subplots(2, 1, sharex = 'col')
+    else:
+        f, ax = plt.subplots()
     l = [0] * (traces + 1)
     for i in range(traces):
-        y.append([0] * npoints)
-        l[i], = plt.plot(x, y[i], c = str( 1. - 0.2 * float(i)), ls = '-')
-    l[traces], = plt.plot(x, [1] * npoints, 'r-', lw = 2, label = "current tune")
-    plt.title("Spectrum")
-    plt.gca().legend()
-    plt.gca().set_xlabel("f / kHz" )
-    plt.gca().set_ylabel("Amplitude / arb. Unit" )
+        l[i], = ax.plot(x, y[i], c = str( 1. - 0.2 * float(i)), ls = '-')
+    l[traces], = ax.plot(x, [1] * npoints, 'r-', lw = 2, label = "current tune")
+    fitline, = ax.plot(x, [1] * npoints, 'k--', lw = 1, label = "fit")
+    fittext = ax.text(0.02, 0.95, "", transform = ax.transAxes, va = 'top')
+    ax.set_title("Spectrum")
+    ax.legend()
+    ax.set_ylabel("Amplitude / arb. Unit" )
+    if history:
+        waterfall = Waterfall(wax, x, history)
+        wax.set_xlabel("f / kHz" )
+        wax.set_ylabel("Sweep")
+    else:
+        ax.set_xlabel("f / kHz" )
     plt.draw()
     return (x, y, l)
     
-def updateplot(updateinterv, xdata, ydata, lines):
+def readspectrum():
+    '''Acquisition source: one sweep over the frequencies xdata'''
     peak = 2800. * (1 + np.random.random() / 100)
-    ydata.append([lorentz(x, peak, 10.)  + 0.05 * np.random.random() for x in xdata])
-    del ydata[0]
-    #print(ydata)
-    for i, line in enumerate(lines):
-        line.set_ydata(ydata[i])
-    plt.gca().relim()
-    plt.gca().autoscale_view()
-    plt.draw()
+    return lorentzian(xdata, 1 / (math.pi * 5), peak, 10.) + 0.05 * np.random.random(len(xdata))
+
+def updateplot(updateinterv, xdata, ydata, lines):
+    samples = acquisition.drain() # all sweeps since the last frame
+    stats.received(samples, acquisition.arrived)
+    spectra = [spectrum for received, spectrum in samples]
+    if spectra:
+        ydata.extend(spectra)
+        if history:
+            waterfall.extend(spectra)
+        #print(ydata)
+        for i, line in enumerate(lines):
+            line.set_ydata(ydata[i])
+        latency = []
+        with stats.timer("fit"):
+            for spectrum in spectra: # every sweep, each fit starts from the previous one
+                params = fitter.fit(xdata, spectrum)
+                latency.append(fitter.latency)
+        fitline.set_ydata(lorentzian(xdata, *params))
+        fittext.set_text("tune %.2f kHz, FWHM %.2f kHz\nfit %.2f ms" % (params[1], params[2], max(latency) * 1e3))
+        print("%i sweeps, tune %.3f kHz, FWHM %.3f kHz, fit %.2f ms (%i iterations)" % (len(spectra), params[1], params[2], max(latency) * 1e3, fitter.iterations))
+        with stats.timer("scale"):
+            ax.relim()
+            ax.autoscale_view()
+        with stats.timer("draw"):
+            ax.figure.canvas.draw()
+        stats.frame(acquisition.dropped)
     plt.pause(updateinterv)
     
 traces = 5
@@ -51,9 +82,19 @@ npoints = 201
 f0 = 3.5 * 750.
 fmax = 3.9 * 750.
 updinterv = 1.
+rate, frames, statsfile, overlay, recording = options(sys.argv[1:], rate = 1.) # sweeps per second, independent of the frame rate 1 / updinterv
+stats = FrameStats("plottest_v3", statsfile)
+history = 500 # sweeps in the waterfall below the spectrum, 0 to show the last traces as grey lines instead
+fitter = LorentzFitter() # tune peak of every sweep
 xdata, ydata, lines = createplot(traces, npoints, f0, fmax)
+if overlay:
+    stats.overlay(ax)
+acquisition = Acquisition(feed(paced(readspectrum, rate), **recording)) # sweeps in the background, not held up by drawing
+acquisition.start()
 try:
-    while True:
+    while frames is None or stats.frames < frames:
         updateplot(updinterv, xdata, ydata, lines)
 except (KeyboardInterrupt):
     sys.exit(0)
+stats.report()
+acquisition.stop()
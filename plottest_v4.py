@@ -11,22 +11,33 @@ import sys, os, math, time, datetime as dt
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from plottools import Acquisition, FrameStats, LorentzFitter, RingBuffer, Waterfall, feed, lorentzian, options, paced
 
-def lorentz(x, xpeak, fwhm):
-    return 1 / (math.pi * fwhm /2 * (1 +((x - xpeak) * 2 / fwhm)**2))
-    
 def createplot(traces, npoints, n0, nmax):
-    x = [n0 + n * (nmax - n0) / npoints for n in range(npoints)]
-    y = [[[0] * npoints], [[0] * npoints]]
+    global fitlines, fittexts, waterfalls
+    x = n0 + np.arange(npoints) * (nmax - n0) / npoints
+    if history: # past spectra in the waterfalls instead of grey lines
+        traces = 0
+    y = [RingBuffer(traces + 1, shape = (npoints,), fill = 0) for j in range(2)] # latest spectra, oldest first
 
     plt.ion()
     #plt.rcParams['text.usetex'] = True
     #plt.rcParams['font.size'] = 12
-    plt.rcParams['savefig.extension'] = 'pdf'
-    f, axarr = plt.subplots(2, 1, sharex='col')
+    plt.rcParams['savefig.format'] = 'pdf'
+    if history: # spectra left, waterfalls right
+        f, grid = plt.subplots(2, 2, sharex='all')
+        axarr = grid[:, 0]
+        waterfalls = [Waterfall(wax, x, history) for wax in grid[:, 1]]
+        grid[1, 1].set_xlabel("f / kHz" )
+        for wax in grid[:, 1]:
+            wax.set_ylabel("Sweep")
+    else:
+        f, axarr = plt.subplots(2, 1, sharex='col')
     f.suptitle("Spectra")
-    plt.xlabel("f / kHz" )
+    axarr[1].set_xlabel("f / kHz" )
     l = [[0] * (traces + 1), [0] * (traces + 1)]
+    fitlines = [0, 0]
+    fittexts = [0, 0]
     for j, ax in enumerate(axarr):
         if j == 0:
             color = "r"
@@ -35,26 +46,50 @@ def createplot(traces, npoints, n0, nmax):
             color = "b"
             direction = "vertical"
         for i in range(traces):
-            y[j].append([0] * npoints)
             l[j][i], = ax.plot(x, y[j][i], c = str( 1. - 0.2 * float(i)), ls = '-')
         l[j][traces], = ax.plot(x, [1] * npoints, '%s-' %color, lw = 2, label = "current %s tune" % direction)
+        fitlines[j], = ax.plot(x, [1] * npoints, 'k--', lw = 1, label = "fit")
+        fittexts[j] = ax.text(0.02, 0.95, "", transform = ax.transAxes, va = 'top')
         ax.legend()
         ax.set_ylabel("Amplitude %s / arb. Unit" % direction)
     plt.draw()
     return (x, y, l, axarr)
     
-def updateplot(u):#, xdata, ydata, lines):
+def readspectra():
+    '''Acquisition source: one sweep over the frequencies xdata in both directions'''
     peak = [0, 0]
-    for j, ax in enumerate(axarr):
+    spectra = []
+    for j in range(2):
         peak[j] = (2800. + j * 50.) * (1 + np.random.random() / 100)
-        ydata[j].append([lorentz(x, peak[j], 10.)  + 0.05 * np.random.random() for x in xdata])
-        del ydata[j][0]
-        #print(ydata)
-        for i, line in enumerate(lines[j]):
-            line.set_ydata(ydata[j][i])
-        ax.relim()
-        ax.autoscale_view()
-    plt.draw()
+        spectra.append(lorentzian(xdata, 1 / (math.pi * 5), peak[j], 10.) + 0.05 * np.random.random(len(xdata)))
+    return spectra
+
+def updateplot(u):#, xdata, ydata, lines):
+    samples = acquisition.drain() # all sweeps since the last frame
+    stats.received(samples, acquisition.arrived)
+    sweeps = [spectra for received, spectra in samples]
+    if sweeps:
+        for j, ax in enumerate(axarr):
+            ydata[j].extend([spectra[j] for spectra in sweeps])
+            if history:
+                waterfalls[j].extend([spectra[j] for spectra in sweeps])
+            #print(ydata)
+            for i, line in enumerate(lines[j]):
+                line.set_ydata(ydata[j][i])
+            latency = []
+            with stats.timer("fit"):
+                for spectra in sweeps: # every sweep, each fit starts from the previous one of the plane
+                    params = fitters[j].fit(xdata, spectra[j])
+                    latency.append(fitters[j].latency)
+            fitlines[j].set_ydata(lorentzian(xdata, *params))
+            fittexts[j].set_text("tune %.2f kHz, FWHM %.2f kHz\nfit %.2f ms" % (params[1], params[2], max(latency) * 1e3))
+            print("%i sweeps, %s tune %.3f kHz, FWHM %.3f kHz, fit %.2f ms (%i iterations)" % (len(sweeps), "hv"[j], params[1], params[2], max(latency) * 1e3, fitters[j].iterations))
+            with stats.timer("scale"):
+                ax.relim()
+                ax.autoscale_view()
+        with stats.timer("draw"):
+            ax.figure.canvas.draw()
+        stats.frame(acquisition.dropped)
     plt.pause(u)
     
 traces = 5
@@ -62,9 +97,19 @@ npoints = 201
 f0 = 3.5 * 750.
 fmax = 3.9 * 750.
 updinterv = 1.
+rate, frames, statsfile, overlay, recording = options(sys.argv[1:], rate = 1.) # sweeps per second, independent of the frame rate 1 / updinterv
+stats = FrameStats("plottest_v4", statsfile)
+history = 500 # sweeps in the waterfalls next to the spectra, 0 to show the last traces as grey lines instead
+fitters = [LorentzFitter(), LorentzFitter()] # tune peaks of every sweep, horizontal and vertical
 xdata, ydata, lines, axarr = createplot(traces, npoints, f0, fmax)
+if overlay:
+    stats.overlay(axarr[0])
+acquisition = Acquisition(feed(paced(readspectra, rate), **recording)) # sweeps in the background, not held up by drawing
+acquisition.start()
 try:
-    while True:
+    while frames is None or stats.frames < frames:
         updateplot(updinterv)#, xdata, ydata, lines)
 except (KeyboardInterrupt):
     sys.exit(0)
+stats.report()
+acquisition.stop()
@@ -9,92 +9,189 @@ Created on Do Oct 22 22:06:50 2015
             
             s.mey@fz-juelich.de
 '''
-import math, time
+import math, sys, time
 import datetime as dt
 import matplotlib.pyplot as plt
 import matplotlib.dates as dates
 import matplotlib.lines as lines
-from matplotlib.animation import FuncAnimation
+from matplotlib.colors import to_rgba
 import numpy as np
+from plottools import Acquisition, FrameStats, RingBuffer, began, datenums, feed, limits, options
 
 
 
+STATES = np.array(["L", "S", "N"]) # lock states published by mqtt_nmr.py
+SAMPLE = [("time", "<f8"), ("state", "U1"), ("field", "<f8")] # of gendata() in --record files
+COLORS = np.array([to_rgba(c) for c in ['g', 'y', 'r', 'k']]) # Green, yellow, red, black for unknown states
+clock = time.time # source of timestamps, simulated by test_plottest_v5.py
+verbose = True # print every received point
+stats = FrameStats("plottest_v5") # frame times, --stats writes them as JSON lines
+
+
 def gendata():
     # data as provided by the mqtt_nmr.py publisher
-    if np.random.random() > 0.9: # probability of 10%
-        field = .5 +  2. * np.random.random() # random numbers from [.5, 2.5] 
-        if field > 1.1 and field < 1.8:
-            state = "L"
-        elif field < 1. or field > 1.9:
-            state = "N"
-        else:
-            state = "S"
-        return time.time(), state, field
+    field = .5 +  2. * np.random.random() # random numbers from [.5, 2.5] 
+    if field > 1.1 and field < 1.8:
+        state = "L"
+    elif field < 1. or field > 1.9:
+        state = "N"
+    else:
+        state = "S"
+    return clock(), state, field
+
+
+def publisher(rate = 10.):
+    '''Local stand-in for the mqtt_nmr.py publisher as acquisition source, blocking until the next sample,
+    samples arrive at random times with rate per second on average'''
+    due = [time.time()]
+    def source():
+        due[0] += np.random.exponential(1. / rate) # Absolute schedule, catches up after the thread was held up
+        delay = due[0] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return gendata()
+    return source
 
 
-def color(string):
-    colors = {"L": 'g', "S": 'y', "N": 'r', "none": 'k'} # Green, yellow, red, black
-    c = colors["none"]
-    for key in colors.keys():
-        if key == string:
-            c = colors[string]
-    return c
+def color(states):
+    '''RGBA colors of one or several lock states as rows, black for unknown states'''
+    states = np.atleast_1d(states)
+    index = np.full(len(states), len(STATES))
+    for k, state in enumerate(STATES):
+        index[states == state] = k
+    return COLORS[index]
 
 
-def createplot(npoints = 120, updinterv = 1.):
-    global f, ax, x, y, c, coll
+def createplot(npoints = 120, updinterv = 1., start = None):
+    global f, ax, xy, c, coll
     plt.rcParams['font.size'] = 14
     plt.rcParams['savefig.format'] = 'pdf'
     plt.rcParams['mathtext.default'] = 'regular'
     f, ax  = plt.subplots(1, 1)
     f.suptitle("Matplotlib Animation Test with Simulated NMR Data")
-    start = time.time()
+    start = time.time() if start is None else start
     #x = [start - updinterv * (npoints - i) for i in range(npoints)]
     timestamps = [start - updinterv * (npoints - i) for i in range(npoints)] # generate list of n timestamps backwards from start
-    x = [dates.date2num(dt.datetime.fromtimestamp(t)) for t in timestamps] # reformat to python.datetime and from there to matplotlib.dates floats and use as x-data
-    y = [0.] * npoints
-    c = ['w'] * npoints
-    coll = ax.scatter(x, y, s = 20, color = c, marker = 'o')
+    xy = RingBuffer(npoints, shape = (2,)) # points (t, B) as offsets of one scatter collection
+    xy.extend([(dates.date2num(dt.datetime.fromtimestamp(t)), 0.) for t in timestamps]) # reformat to python.datetime and from there to matplotlib.dates floats and use as x-data
+    c = RingBuffer(npoints, shape = (4,), fill = to_rgba('w')) # RGBA colors
+    coll = ax.scatter(xy.values[:, 0], xy.values[:, 1], s = 30, facecolors = c.values, edgecolors = 'face', marker = 'o',
+                      animated = True) # drawn by blitplot only
     f.autofmt_xdate() # or
     #plt.xticks(rotation = 25)
     ax.xaxis.set_major_formatter(dates.DateFormatter('%H:%M:%S'))
     ax.set_xlabel("t / s")
     ax.set_ylabel("B / T")
-    lock = lines.Line2D([], [], color='g', marker='o', markeredgecolor = 'g', markersize=10, linestyle = 'NONE', label='Locked')
-    search = lines.Line2D([], [], color='y', marker='o', markeredgecolor = 'y', markersize=10, linestyle = 'NONE', label='Searching')
-    nolock = lines.Line2D([], [], color='r', marker='o', markeredgecolor = 'r', markersize=10, linestyle = 'NONE', label='No Lock')
+    lock = lines.Line2D([], [], color='g', marker='o', markeredgecolor = 'g', markersize=10, linestyle = 'None', label='Locked')
+    search = lines.Line2D([], [], color='y', marker='o', markeredgecolor = 'y', markersize=10, linestyle = 'None', label='Searching')
+    nolock = lines.Line2D([], [], color='r', marker='o', markeredgecolor = 'r', markersize=10, linestyle = 'None', label='No Lock')
     ax.legend([lock, search, nolock], ["Locked", "Searching", "No Lock"]) # manual legend
     return coll,
 
 
-def updateplot(frame):
+def updateplot():
+    '''Add all data received since the last frame to the collection, returns True if the axes were rescaled'''
+    rescaled = False
     try:
-        data = gendata()
-        if data:
-            time = float(data[0])
-            lock = str(data[1])
-            field = float(data[2])
-            print(time, lock, field, len(x))
-            #x.append(time)
-            x.append(dates.date2num(dt.datetime.fromtimestamp(time))) # add timestamp from x data to x
-            del x[0] # loose oldest x data
-            y.append(field) # same for y data
-            del y[0]
-            c.append(color(lock)) #same for color data
-            del c[0]
-        coll = ax.scatter(x, y, s = 30, color = c, marker = 'o')
-        ax.relim() # new axes limits from data
-        #ax.autoscale_view() #autoscale axes to new limits, breaks matplotlib.dates.Dateformatter???
+        samples = acquisition.drain() # all data received since the last frame
+        stats.received(samples, acquisition.arrived)
+        if samples:
+            times, locks, fields = zip(*[data for received, data in samples])
+            if verbose:
+                print(times[-1], locks[-1], fields[-1], len(xy), "%i samples, %i dropped" % (len(samples), acquisition.dropped))
+            xy.extend(np.column_stack((datenums(times), fields))) # add points, loosing the oldest
+            c.extend(color(np.array(locks))) #same for color data
+            coll.set_offsets(xy.values) # update the one collection in place
+            coll.set_facecolors(c.values)
+            with stats.timer("scale"):
+                rescaled = rescale()
     except KeyboardInterrupt:
         print("exiting")
-    return coll,
+    return rescaled
+
+
+def artists():
+    '''Artists redrawn every frame, the collection and the statistics overlay if shown'''
+    return (coll, stats.text) if stats.text else (coll,)
+
+
+def rescale():
+    '''New axes limits if points left them or the time window moved on, returns True if they changed'''
+    xlim = limits(xy[0][0], xy[-1][0], ax.get_xlim(), (0., .2)) # room for new points
+    ylim = limits(xy.values[:, 1].min(), xy.values[:, 1].max(), ax.get_ylim(), (.1, .1))
+    if xlim:
+        ax.set_xlim(xlim)
+    if ylim:
+        ax.set_ylim(ylim)
+    return bool(xlim or ylim)
+
+
+def ondraw(event):
+    '''Cache the axes background without the animated artists after every full draw, e.g. rescaling or resizing'''
+    global bg
+    bg = f.canvas.copy_from_bbox(ax.bbox)
+    blitplot()
+
+
+def blitplot():
+    '''Restore the cached background and draw only the collection and the statistics overlay on top'''
+    f.canvas.restore_region(bg)
+    for artist in artists():
+        ax.draw_artist(artist)
+    f.canvas.blit(ax.bbox)
+
+
+def step():
+    '''One frame: update the collection, then blit it, or redraw everything if the axes were rescaled.
+    Drawing is timed as draw and ends the frame of stats.'''
+    rescaled = updateplot()
+    with stats.timer("draw"):
+        if rescaled or bg is None:
+            f.canvas.draw() # Full redraw, ondraw caches the new background
+        else:
+            blitplot()
+    stats.frame(acquisition.dropped)
+
+
+def animate(f):
+    '''Blit the collection every 10 ms from a timer of the canvas, returns the started timer'''
+    global bg
+    bg = None
+    if stats.text:
+        stats.text.set_animated(True)
+    f.canvas.mpl_connect('draw_event', ondraw)
+    timer = f.canvas.new_timer(interval = 10)
+    timer.add_callback(step)
+    timer.start()
+    return timer
 
 
-def main():
-    createplot(60, .1)
-    an = FuncAnimation(f, updateplot, interval = 10)#, blit = True)
-    plt.show()
+def main(argv):
+    '''plottest_v5.py with the options() of the live plotters, --rate [samples per second of the stand-in publisher]
+    default 10, --frames [headless run of frames]'''
+    global acquisition, stats
+    rate, frames, statsfile, overlay, recording = options(argv, rate = 10.)
+    if statsfile:
+        stats = FrameStats("plottest_v5", statsfile)
+    if frames: # Benchmark in real time without a display
+        plt.switch_backend("Agg")
+    acquisition = Acquisition(feed(publisher(rate), dtype = SAMPLE, **recording)) # source could as well read from the MQTT broker
+    acquisition.start()
+    createplot(60, .1, began(**recording))
+    if overlay:
+        stats.overlay(ax)
+    timer = animate(f)
+    if frames:
+        timer.stop() # No event loop, frames are drawn here
+        f.canvas.draw() # Caches the background
+        for frame in range(frames): # What the timer would do every 10 ms
+            step()
+            time.sleep(.01)
+        stats.report()
+    else:
+        plt.show()
+    acquisition.stop()
 
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv[1:])
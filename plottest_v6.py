@@ -6,28 +6,252 @@ Created on Sat Oct 24 19:45:34 2015
 @author:    Sebastian Mey
             Institut für Kernphysik
             Forschungszentrum Jülich GmbH
-            
+
             s.mey@fz-juelich.de
 """
-
-from mpl_toolkits.mplot3d import axes3d
+import getopt, sys, time, warnings
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
+from plottools import FACECOST, FieldGrid, stride
+
+
+PHASES = [0, 1, 2, 7] # trajectory files of fittest_classbased.py
+FIELDS = ["Bx", "By", "Bz", "Ex", "Ey", "Ez", "absB", "absE", "unwantedB", "unwantedE"] # columns that can be mapped
+CHUNK = 1 << 20 # trajectory points derived and gridded at once
+
+
+def usage():
+    '''Usage function'''
+    print("""Show field maps over the x-z plane averaged from trajectory points as 3-D surfaces with contours
+
+Usage: %s -h -i [basename] -f [fields] -b [bins] -t [seconds] -n [points] -o [file]
+
+-h                  Show this help message and exit
+-i [basename]       Basename of the trajectory files of fittest_classbased.py, default random test data (-n)
+-f [fields]         Comma separated fields to map, default Bx,By,Bz,Ex,Ey,Ez, choose from:
+                    %s
+-b [bins]           Grid cells in x and z as NXxNZ or N, default 200
+-t [seconds]        Time to draw a surface in, sets its stride, default 0.2
+-n [points]         Number of test data points without -i, default 1000000
+-o [file]           Render the first field to file without a window
+
+Keys: n/p next/previous field, +/- double/halve the draw time, rotating with the mouse draws a coarser surface
+""" % (sys.argv[0], ",".join(FIELDS)))
+
+
+def testpoints(n, seed=0):
+    '''Extent and one chunk of x, z and value of n random points on the surface of axes3d.get_test_data'''
+    rng = np.random.default_rng(seed)
+    x, z = rng.uniform(-3., 3., (2, n))
+    z1 = np.exp(-(x**2 + z**2) / 2) / (2 * np.pi)
+    z2 = np.exp(-(((x - 1) / 1.5)**2 + ((z - 1) / .5)**2) / 2) / (2 * np.pi * .5 * 1.5)
+    return [(-30., 30.), (-30., 30.)], [(x * 10, z * 10, {"test": (z2 - z1) * 500})]
+
+
+def readpoints(basename, fields):
+    '''Extent of x and z of the trajectory points of all phase files of basename and a generator of chunks of their
+    x, z and a dict of fields, read memory-mapped through the binary cache of fittest_classbased.py'''
+    import fittest_classbased as fit # tqdm and the trajectory parser only needed for real data
+    traces = [fit.readcached(basename + "_%s-pi-quarter_small_trajectory.dat" % phase) for phase in PHASES]
+    traces = [(ids, data) for ids, data in traces if len(ids)]
+    extent = []
+    for name in ("x", "z"):
+        low = min((np.nanmin(data[fit.RAW.index(name)]) for ids, data in traces), default = np.inf)
+        high = max((np.nanmax(data[fit.RAW.index(name)]) for ids, data in traces), default = -np.inf)
+        if not low < high: # Constant (e.g. a reference particle on axis) or no values
+            low, high = (low - 0.5, high + 0.5) if np.isfinite(low) else (-0.5, 0.5)
+        extent.append((low, high))
+    def chunks():
+        for ids, data in traces:
+            for n in range(0, len(ids), CHUNK):
+                table = fit.lorentz(ids[n:n + CHUNK], data[:, n:n + CHUNK], ["x", "z"] + fields)
+                yield table[0], table[1], dict(zip(fields, table[2:]))
+    return extent, chunks()
+
+
+def gridpoints(extent, chunks, bins):
+    '''FieldGrid over extent of each field of chunks of points'''
+    grids = {}
+    points = 0
+    start = time.perf_counter()
+    for x, z, values in chunks:
+        for field, v in values.items():
+            if field not in grids:
+                grids[field] = FieldGrid(extent, bins)
+            grids[field].add(x, z, v)
+        points += len(x)
+    print("Gridded %i points of %s on %ix%i cells in %.2f s" % (points, ",".join(grids), bins[0], bins[1], time.perf_counter() - start))
+    return grids
+
+
+class FieldView:
+    '''Surface of the mean of one field per cell of its FieldGrid over the x-z plane on the 3-D axes ax, with its
+    contours on the floor and profiles on the walls. The surface stride follows from the grid size and the time
+    budget of a draw, using the time per face measured on every draw(), and is 10 times coarser while the view is
+    rotated with the mouse. Surfaces of each field and stride and contour sets of each field are created once and
+    then only hidden and shown again.'''
+    def __init__(self, ax, grids, budget=.2, levels=10):
+        self.ax = ax
+        self.grids = grids
+        self.fields = list(grids)
+        self.budget = budget
+        self.levels = levels
+        self.facecost = FACECOST
+        self.surfaces = {} # (field, stride) -> surface
+        self.contours = {} # field -> contour sets of floor and walls
+        self.field = None
+        self.stride = None
+        self.rotating = False
+        canvas = ax.figure.canvas
+        canvas.mpl_connect('button_press_event', self.onpress)
+        canvas.mpl_connect('button_release_event', self.onrelease)
+        canvas.mpl_connect('key_press_event', self.onkey)
+
+    def limits(self, field):
+        '''Value range of field with room below for the floor contours'''
+        mean = self.grids[field].mean
+        low, high = np.nanmin(mean), np.nanmax(mean)
+        span = (high - low) or abs(high) or 1.
+        return low - span, high + .1 * span
+
+    def surface(self, field, stride):
+        if (field, stride) not in self.surfaces:
+            X, Z = self.grids[field].centers()
+            self.surfaces[field, stride] = self.ax.plot_surface(X, Z, self.grids[field].mean, rstride = stride, cstride = stride,
+                                                                alpha = 0.3)
+        return self.surfaces[field, stride]
+
+    def contoursets(self, field):
+        '''Contours of field on the floor, and on the walls its maximum and mean over x along z and over z along x,
+        leaving out empty cells'''
+        if field not in self.contours:
+            grid = self.grids[field]
+            X, Z = grid.centers()
+            mean = grid.mean
+            (x0, x1), (z0, z1) = grid.extent
+            start = time.perf_counter()
+            artists = [self.ax.contour(X, Z, mean, self.levels, zdir = 'z', offset = self.limits(field)[0], cmap = cm.coolwarm)]
+            with warnings.catch_warnings(): # Rows and columns without points give NaN, gaps in the profiles
+                warnings.simplefilter("ignore", RuntimeWarning)
+                for axis, along, zdir, offset in ((0, Z[0], 'x', x0), (1, X[:, 0], 'y', z1)):
+                    for profile, color, style in ((np.nanmax, cm.coolwarm(1.), '-'), (np.nanmean, cm.coolwarm(0.), '--')):
+                        artists += self.ax.plot(along, profile(mean, axis = axis), style, color = color, zs = offset, zdir = zdir)
+            self.contours[field] = artists
+            print("Contours of %s in %.1f ms" % (field, (time.perf_counter() - start) * 1e3))
+        return self.contours[field]
+
+    def show(self, field=None, stride=None):
+        '''Show field, default the current one, at stride, default the one fitting the budget'''
+        field = field or self.field or self.fields[0]
+        if stride is None:
+            stride = self.choose()
+        if (field, stride) == (self.field, self.stride):
+            return
+        for artist in self.artists():
+            artist.set_visible(False)
+        self.field, self.stride = field, stride
+        for artist in self.artists():
+            artist.set_visible(True)
+        grid = self.grids[field]
+        self.ax.set_xlim(*grid.extent[0])
+        self.ax.set_ylim(*grid.extent[1])
+        self.ax.set_zlim(*self.limits(field))
+        self.ax.set_xlabel('x')
+        self.ax.set_ylabel('z')
+        self.ax.set_zlabel(field)
+        self.ax.set_title("%s, %ix%i cells, stride %i" % (field, grid.bins[0], grid.bins[1], stride))
+
+    def artists(self):
+        if self.field is None:
+            return []
+        return [self.surface(self.field, self.stride)] + self.contoursets(self.field)
+
+    def choose(self, budget=None):
+        '''Stride of the current field drawn in budget, default the budget of the view'''
+        return stride(self.grids[self.field or self.fields[0]].bins, budget or self.budget, self.facecost)
+
+    def draw(self):
+        '''Draw the figure, then update the time per face from how long it took'''
+        start = time.perf_counter()
+        self.ax.figure.canvas.draw()
+        elapsed = time.perf_counter() - start
+        bins = self.grids[self.field].bins
+        faces = -(-bins[0] // self.stride) * -(-bins[1] // self.stride)
+        self.facecost = .5 * self.facecost + .5 * elapsed / faces # Smoothed, a single slow draw does not coarsen for long
+        print("%s stride %i: %i faces drawn in %.1f ms" % (self.field, self.stride, faces, elapsed * 1e3))
+        return elapsed
+
+    def onpress(self, event):
+        if event.inaxes is self.ax and not self.rotating:
+            self.rotating = True
+            self.show(stride = self.choose(self.budget / 10))
+
+    def onrelease(self, event):
+        if self.rotating:
+            self.rotating = False
+            self.show()
+            self.draw()
+
+    def onkey(self, event):
+        if event.key in ("n", "p"):
+            k = self.fields.index(self.field) + (1 if event.key == "n" else -1)
+            self.show(self.fields[k % len(self.fields)])
+        elif event.key in ("+", "-"):
+            self.budget *= 2. if event.key == "+" else .5
+            self.show()
+        else:
+            return
+        self.draw()
+
+
+def main(argv):
+    basename = None
+    fields = ["Bx", "By", "Bz", "Ex", "Ey", "Ez"]
+    bins = (200, 200)
+    budget = .2
+    points = 1000000
+    output = None
+    try:
+        opts, args = getopt.getopt(argv, "hi:f:b:t:n:o:")
+    except getopt.GetoptError as err:
+        print(str(err) + "\n")
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt == "-i":
+            basename = arg
+        elif opt == "-f":
+            fields = arg.split(",")
+            for field in fields:
+                if field not in FIELDS:
+                    print("Unknown field %s, choose from %s\n" % (field, ",".join(FIELDS)))
+                    usage()
+                    sys.exit(2)
+        elif opt == "-b":
+            bins = tuple(int(n) for n in arg.split("x")) * (1 if "x" in arg else 2)
+        elif opt == "-t":
+            budget = float(arg)
+        elif opt == "-n":
+            points = int(arg)
+        elif opt == "-o":
+            output = arg
+    if output:
+        plt.switch_backend("Agg")
+    grids = gridpoints(*(readpoints(basename, fields) if basename else testpoints(points)), bins)
+    fig = plt.figure()
+    ax = fig.add_subplot(projection = '3d')
+    view = FieldView(ax, grids, budget)
+    view.show()
+    view.draw()
+    if output:
+        fig.savefig(output)
+    else:
+        plt.show()
+
 
-fig = plt.figure()
-ax = fig.gca(projection='3d')
-X, Y, Z = axes3d.get_test_data(0.05)
-print(Z)
-ax.plot_surface(X, Y, Z, rstride=8, cstride=8, alpha=0.3)
-cset = ax.contour(X, Y, Z, zdir='z', offset=-100, cmap=cm.coolwarm)
-cset = ax.contour(X, Y, Z, zdir='x', offset=-40, cmap=cm.coolwarm)
-cset = ax.contour(X, Y, Z, zdir='y', offset=40, cmap=cm.coolwarm)
-
-ax.set_xlabel('X')
-ax.set_xlim(-40, 40)
-ax.set_ylabel('Y')
-ax.set_ylim(-40, 40)
-ax.set_zlabel('Z')
-ax.set_zlim(-100, 100)
-
-plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+    main(sys.argv[1:])
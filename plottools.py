@@ -0,0 +1,662 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Shared helpers of the live plotting scripts plottest_v*.py
+'''
+import ast, collections, contextlib, getopt, json, os, sys, threading, time, datetime as dt
+import numpy as np
+import matplotlib.dates as mdates
+
+
+class RingBuffer:
+    '''Rolling window of the last size values (scalars or arrays of shape) in a preallocated NumPy array.
+    Every value is stored twice, at k and k + size, so appending is O(1) and the window in order from
+    oldest to newest is always a contiguous view that can be handed to matplotlib without copying.'''
+    def __init__(self, size, shape=(), dtype=float, fill=None):
+        self.size = size
+        self.data = np.zeros((2 * size,) + tuple(shape), dtype = dtype)
+        self.pos = 0 # index the next value is written to
+        self.count = 0
+        if fill is not None: # Start with a full window of fill values
+            self.data[:] = fill
+            self.count = size
+
+    def append(self, value):
+        '''Add value as newest, dropping the oldest value of a full window'''
+        self.data[self.pos] = value
+        self.data[self.pos + self.size] = value
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def extend(self, values):
+        '''Add several values at once, oldest first'''
+        values = np.asarray(values, dtype = self.data.dtype)[-self.size:]
+        index = (self.pos + np.arange(len(values))) % self.size
+        self.data[index] = values
+        self.data[index + self.size] = values
+        self.pos = (self.pos + len(values)) % self.size
+        self.count = min(self.count + len(values), self.size)
+
+    @property
+    def values(self):
+        '''View of the window from oldest to newest value'''
+        return self.data[self.pos + self.size - self.count:self.pos + self.size]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values if dtype is None else self.values.astype(dtype)
+
+
+class Pyramid:
+    '''Whole history of a timeline with increasing x and one or more value columns, kept as the samples
+    themselves (level 0) and as levels k of bins over factor**k samples with first and last x and the minimum
+    and maximum of each column. Levels are updated as samples arrive, only for bins that became complete.
+    view() takes the coarsest level that still has as many bins in the x-range as there are pixels, so drawing
+    costs the same for minutes and hours of history and no peak is lost to decimation.'''
+    def __init__(self, columns=1, factor=4, capacity=1 << 10):
+        self.columns = columns
+        self.factor = factor
+        self.capacity = capacity
+        x = np.empty(capacity)
+        values = np.empty((capacity, columns))
+        self.levels = [[x, x, values, values]] # first x, last x, low, high of each bin, the samples at level 0
+        self.counts = [0]
+        self.level = 0 # of the last view
+
+    def __len__(self):
+        return self.counts[0]
+
+    def append(self, k, first, last, low, high):
+        '''Add bins to level k, doubling its arrays when full'''
+        arrays = self.levels[k]
+        n = self.counts[k]
+        if n + len(first) > len(arrays[0]):
+            size = max(2 * len(arrays[0]), n + len(first))
+            grown = {} # level 0 shares arrays between first and last, low and high
+            for array in arrays:
+                if id(array) not in grown:
+                    grown[id(array)] = np.empty((size,) + array.shape[1:])
+                    grown[id(array)][:n] = array[:n]
+            arrays = self.levels[k] = [grown[id(array)] for array in arrays]
+        for array, values in zip(arrays, (first, last, low, high)):
+            array[n:n + len(first)] = values
+        self.counts[k] = n + len(first)
+
+    def extend(self, x, values):
+        '''Add samples at x with values of shape (n,) or (n, columns), oldest first'''
+        x = np.asarray(x, dtype = float)
+        values = np.asarray(values, dtype = float).reshape(len(x), self.columns)
+        self.append(0, x, x, values, values)
+        f = self.factor
+        k = 0
+        while k + 1 < len(self.levels) or self.counts[k] >= f: # Complete bins of level k go to level k + 1
+            if k + 1 == len(self.levels):
+                self.levels.append([np.empty(self.capacity), np.empty(self.capacity),
+                                    np.empty((self.capacity, self.columns)), np.empty((self.capacity, self.columns))])
+                self.counts.append(0)
+            done = self.counts[k + 1] * f
+            n = (self.counts[k] - done) // f
+            if not n:
+                break
+            first, last, low, high = [array[done:done + n * f] for array in self.levels[k]]
+            self.append(k + 1, first[::f], last[f - 1::f], low.reshape(n, f, -1).min(axis = 1),
+                        high.reshape(n, f, -1).max(axis = 1))
+            k += 1
+
+    def view(self, x0=-np.inf, x1=np.inf, bins=1000):
+        '''First x, last x, low and high values of the bins from x0 to x1 at the coarsest level with at most about
+        bins of them, followed by the samples and bins of finer levels not complete at that level yet'''
+        x = self.levels[0][0][:self.counts[0]]
+        samples = np.searchsorted(x, x1, 'right') - np.searchsorted(x, x0)
+        k = 0
+        while k + 1 < len(self.levels) and samples > bins * self.factor**k:
+            k += 1
+        self.level = k
+        parts = []
+        for j in range(k, -1, -1):
+            done = self.counts[j + 1] * self.factor if j < k else 0
+            first, last, low, high = [array[done:self.counts[j]] for array in self.levels[j]]
+            i0 = np.searchsorted(last, x0)
+            i1 = np.searchsorted(first, x1, 'right')
+            parts.append((first[i0:i1], last[i0:i1], low[i0:i1], high[i0:i1]))
+        return [np.concatenate(arrays) for arrays in zip(*parts)]
+
+
+def limits(low, high, lim, pad):
+    '''New axis limits around data from low to high padded by pad = (below, above) times its range,
+    None while the data stays within lim and fills at least a quarter of it (hysteresis)'''
+    span = high - low
+    if lim[0] <= low and high <= lim[1] and (span * 4 >= lim[1] - lim[0] or not span):
+        return None
+    if lim[0] > low or high > lim[1]: # Growing data grows the limits geometrically
+        span = max(span, lim[1] - lim[0])
+    span = span or abs(high) or 1.
+    return low - pad[0] * span, high + pad[1] * span
+
+
+def datenums(timestamps):
+    '''Matplotlib date numbers of POSIX timestamps in local time, like date2num(datetime.fromtimestamp(t))
+    of each but vectorized'''
+    timestamps = np.asarray(timestamps, dtype = float)
+    if not len(timestamps):
+        return timestamps
+    offset = time.localtime(timestamps[0]).tm_gmtoff
+    if time.localtime(timestamps[-1]).tm_gmtoff != offset or np.ptp(timestamps) > 86400.: # Daylight saving time may change in between
+        return np.array([mdates.date2num(dt.datetime.fromtimestamp(t)) for t in timestamps])
+    return mdates.date2num(dt.datetime(1970, 1, 1)) + (timestamps + offset) / 86400.
+
+
+class Acquisition(threading.Thread):
+    '''Producer thread reading samples of source() into a bounded queue as (timestamp, sample), so input is
+    not tied to the frame rate. source may block until its next sample, or return None if there is none.
+    Samples are timestamped when they arrive, unless source.timed is set and source returns (timestamp, sample)
+    pairs itself, like replay(). The renderer takes all pending samples once per frame with drain(), the oldest
+    are dropped if it falls more than maxsize samples behind.'''
+    def __init__(self, source, maxsize=1 << 16, idle=1e-3):
+        threading.Thread.__init__(self, daemon = True)
+        self.source = source
+        self.timed = getattr(source, "timed", False)
+        self.queue = collections.deque(maxlen = maxsize) # append and popleft are atomic, no lock needed
+        self.idle = idle # seconds to wait after source returned None
+        self.produced = 0
+        self.consumed = 0
+        self.arrived = [] # arrival times of the samples of the last drain()
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            sample = self.source()
+            if sample is None:
+                time.sleep(self.idle)
+                continue
+            now = time.time()
+            self.queue.append(tuple(sample) + (now,) if self.timed else (now, sample, now))
+            self.produced += 1
+
+    def drain(self):
+        '''Take all pending (timestamp, sample) pairs, oldest first, and keep their arrival times in arrived'''
+        samples = []
+        arrived = []
+        for k in range(len(self.queue)):
+            timestamp, sample, arrival = self.queue.popleft()
+            samples.append((timestamp, sample))
+            arrived.append(arrival)
+        self.arrived = arrived
+        self.consumed += len(samples)
+        return samples
+
+    @property
+    def dropped(self):
+        '''Number of samples lost because the queue was full'''
+        return self.produced - self.consumed - len(self.queue)
+
+    def stop(self, timeout=1.):
+        self.stopping.set()
+        self.join(timeout)
+
+
+def paced(function, rate):
+    '''Acquisition source calling function rate times per second, sleeping until the next call is due'''
+    period = 1. / rate
+    due = [time.perf_counter()]
+    def source():
+        delay = due[0] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        due[0] = max(due[0], time.perf_counter() - period) + period # No burst of calls after a stall
+        return function()
+    return source
+
+
+class Waterfall:
+    '''History of spectra over x as one image on ax, oldest at the bottom, updated in place. Spectra are reduced
+    to at most width columns and the history to at most height rows (default the pixel size of ax) by the
+    maximum of neighbouring bins and spectra, so peaks stay visible and drawing costs about as much as the
+    pixels shown, whatever the number of bins and spectra.'''
+    def __init__(self, ax, x, history, width=None, height=None, **kwargs):
+        extent = ax.get_window_extent()
+        width = int(width or extent.width)
+        height = int(height or extent.height)
+        self.edges = np.linspace(0, len(x), min(len(x), width) + 1).astype(int)[:-1] # first bin of each column
+        self.rowedges = np.linspace(0, history, min(history, height) + 1).astype(int)[:-1] # first spectrum of each row
+        self.rows = RingBuffer(history, shape = (len(self.edges),), fill = np.nan)
+        kwargs.setdefault('vmin', 0.)
+        kwargs.setdefault('vmax', 1.)
+        self.image = ax.imshow(self.pixels(), aspect = 'auto', interpolation = 'nearest', origin = 'lower',
+                               extent = (x[0], x[-1], -history, 0), **kwargs)
+
+    def extend(self, spectra):
+        '''Add spectra as rows, oldest first, and rescale the colors if the history left their range'''
+        self.rows.extend(np.maximum.reduceat(np.asarray(spectra, dtype = float), self.edges, axis = 1))
+        pixels = self.pixels()
+        self.image.set_data(pixels)
+        clim = limits(np.nanmin(pixels), np.nanmax(pixels), self.image.get_clim(), (0., 0.))
+        if clim:
+            self.image.set_clim(clim)
+        return self.image
+
+    def pixels(self):
+        '''Image rows, the history reduced to the height of the image'''
+        if len(self.rowedges) == len(self.rows):
+            return self.rows.values
+        return np.fmax.reduceat(self.rows.values, self.rowedges, axis = 0) # ignores the NaN rows of a new history
+
+
+class FrameStats:
+    '''Instrumentation of a live plotter: time between drawn frames, time spent per frame in timer() sections
+    such as "draw" and "scale", latency from receiving the oldest sample of a frame to the end of that frame,
+    and samples coalesced into one frame or dropped by the acquisition. p50/p95/p99 of the last window frames
+    are written as JSON lines every interval seconds to file (path, "-" for stdout, None for no output) and
+    shown every second on the overlay() text, if any.'''
+    def __init__(self, name, file=None, interval=10., window=1 << 12):
+        self.name = name
+        self.file = sys.stdout if file == "-" else open(file, 'a') if file else None
+        self.interval = interval
+        self.window = window
+        self.times = {"frame": RingBuffer(window), "latency": RingBuffer(window)} # seconds
+        self.current = {} # seconds in timer() sections of this frame
+        self.pending = [] # receive timestamps of the samples of this frame
+        self.frames = 0
+        self.samples = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.last = None # end of the last frame
+        self.reported = (time.perf_counter(), 0, 0, 0, 0) # time, frames, samples, coalesced, dropped of the last report
+        self.shown = 0. # time of the last overlay update
+        self.text = None
+
+    def overlay(self, ax):
+        '''Text in the lower right corner of ax showing the percentiles'''
+        self.text = ax.text(0.98, 0.02, "", transform = ax.transAxes, ha = 'right', va = 'bottom', family = 'monospace',
+                            fontsize = 'small', bbox = dict(facecolor = 'w', alpha = .7))
+        return self.text
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        '''Add the time spent in the with block to section name of this frame'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] = self.current.get(name, 0.) + time.perf_counter() - start
+
+    def received(self, samples, arrived=None):
+        '''Count (timestamp, sample) pairs drawn in this frame, as returned by Acquisition.drain, with the latency
+        from arrived, the arrival times of Acquisition.arrived, default their timestamps'''
+        self.pending += [received for received, sample in samples] if arrived is None else list(arrived)
+
+    def frame(self, dropped=0):
+        '''End a drawn frame, dropped is the number of samples the acquisition dropped so far'''
+        now = time.perf_counter()
+        if self.last is not None:
+            self.times["frame"].append(now - self.last)
+        self.last = now
+        for name, seconds in self.current.items():
+            if name not in self.times:
+                self.times[name] = RingBuffer(self.window)
+            self.times[name].append(seconds)
+        self.current = {}
+        if self.pending:
+            self.times["latency"].append(time.time() - min(self.pending))
+            self.samples += len(self.pending)
+            self.coalesced += len(self.pending) - 1
+            self.pending = []
+        self.dropped = dropped
+        self.frames += 1
+        if self.text and now - self.shown >= 1.:
+            self.text.set_text(self.format())
+            self.shown = now
+        if self.file and now - self.reported[0] >= self.interval:
+            self.report()
+
+    def percentiles(self, name):
+        '''p50, p95 and p99 of section name in milliseconds, None before the first frame'''
+        if name not in self.times or not len(self.times[name]):
+            return None
+        return dict(zip(("p50", "p95", "p99"), np.round(np.percentile(self.times[name].values, (50, 95, 99)) * 1e3, 3).tolist()))
+
+    def format(self):
+        '''Overlay text, one line per section'''
+        lines = ["%-7s %s ms" % (name, "/".join("%.1f" % value for value in self.percentiles(name).values()))
+                 for name in self.times if self.percentiles(name)]
+        return "p50/p95/p99\n" + "\n".join(lines) + "\n%i coalesced, %i dropped" % (self.coalesced, self.dropped)
+
+    def report(self):
+        '''Write the percentiles and counts since the last report as one JSON line, and return them'''
+        now = time.perf_counter()
+        since, frames, samples, coalesced, dropped = self.reported
+        report = {"name": self.name, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "frames": self.frames - frames,
+                  "fps": (self.frames - frames) / (now - since), "samples": self.samples - samples,
+                  "coalesced": self.coalesced - coalesced, "dropped": self.dropped - dropped}
+        report.update({name: self.percentiles(name) for name in self.times})
+        self.reported = (now, self.frames, self.samples, self.coalesced, self.dropped)
+        if self.file:
+            self.file.write(json.dumps(report) + "\n")
+            self.file.flush()
+        return report
+
+
+RECORDMAGIC = b"PLOTREC\x01"
+RECORDHEADER = 4096 # bytes before the first record
+
+
+class Recording:
+    '''Append-only binary log of timestamped samples of one NumPy dtype and shape, e.g. spectra, read back
+    through a memory map. The file starts with a header of RECORDHEADER bytes holding the record dtype like
+    .npy files do, records are appended unbuffered behind it so a reader or replay can follow a growing
+    file, and a last record cut short by a crash is ignored. Every stride-th timestamp is also appended to
+    the sparse index path + ".idx", so at() finds the record of a time by a search in the index and then
+    in one stride of records, without scanning the log. The sample dtype is taken from the first sample
+    appended to a new file unless given.'''
+    def __init__(self, path, dtype=None, stride=1024):
+        self.path = path
+        self.stride = stride
+        self.dtype = None # of records, time and sample
+        self.file = None # for appending
+        self.memmap = None
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f:
+                if f.read(len(RECORDMAGIC)) != RECORDMAGIC:
+                    raise ValueError("%s is not a recording" % path)
+                header = ast.literal_eval(f.read(RECORDHEADER - len(RECORDMAGIC)).decode().strip())
+            self.dtype = np.lib.format.descr_to_dtype(header["descr"])
+            self.stride = header["stride"]
+        elif dtype is not None:
+            self.create(np.dtype(dtype), ())
+
+    def create(self, dtype, shape):
+        '''Start a new file for samples of dtype and shape'''
+        self.dtype = np.dtype([("time", "<f8"), ("sample", dtype, shape)])
+        header = repr({"descr": np.lib.format.dtype_to_descr(self.dtype), "stride": self.stride}).encode()
+        if len(RECORDMAGIC) + len(header) >= RECORDHEADER:
+            raise ValueError("Sample dtype too complex for a recording header")
+        with open(self.path, 'wb') as f:
+            f.write(RECORDMAGIC + header.ljust(RECORDHEADER - len(RECORDMAGIC) - 1) + b"\n")
+        open(self.path + ".idx", 'wb').close()
+
+    def append(self, timestamp, sample):
+        '''Add sample received at timestamp (POSIX seconds), after all earlier ones'''
+        if self.dtype is None:
+            sample = np.asarray(sample)
+            self.create(sample.dtype, sample.shape)
+        if self.file is None:
+            self.count = len(self)
+            os.truncate(self.path, RECORDHEADER + self.count * self.dtype.itemsize) # Drop a record cut short
+            self.file = open(self.path, 'ab', buffering = 0)
+        self.file.write(np.array((timestamp, sample), dtype = self.dtype).tobytes())
+        if self.count % self.stride == 0:
+            with open(self.path + ".idx", 'ab') as f:
+                f.write(np.float64(timestamp).tobytes())
+        self.count += 1
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __len__(self):
+        if self.dtype is None:
+            return 0
+        return max(os.path.getsize(self.path) - RECORDHEADER, 0) // self.dtype.itemsize
+
+    @property
+    def records(self):
+        '''Memory map of all complete records, mapped again when the file has grown'''
+        n = len(self)
+        if self.memmap is None or len(self.memmap) < n:
+            self.memmap = np.memmap(self.path, dtype = self.dtype, mode = 'r', offset = RECORDHEADER, shape = (n,)) if n else np.empty(0, self.dtype)
+        return self.memmap
+
+    def index(self):
+        '''Timestamps of every stride-th record, rebuilt from the records if the index file is missing or behind'''
+        n = -(-len(self) // self.stride)
+        index = np.fromfile(self.path + ".idx", dtype = "<f8") if os.path.exists(self.path + ".idx") else np.empty(0)
+        if len(index) < n:
+            index = np.array(self.records["time"][::self.stride]) # one page per stride
+            index.tofile(self.path + ".idx")
+        return index[:n]
+
+    def at(self, timestamp):
+        '''Number of the first record at or after timestamp'''
+        block = max(np.searchsorted(self.index(), timestamp, 'right') - 1, 0) * self.stride
+        return block + int(np.searchsorted(self.records["time"][block:block + self.stride], timestamp))
+
+
+def recorded(source, recording):
+    '''Acquisition source returning what source returns and appending it with the time to recording'''
+    def record():
+        sample = source()
+        if sample is not None:
+            recording.append(time.time(), sample)
+        return sample
+    return record
+
+
+def replay(recording, speed=1., start=None):
+    '''Acquisition source returning the samples of recording from timestamp start on, default from the first,
+    with their recorded timestamps as (timestamp, sample), at speed times the recorded pace or as fast as possible
+    for speed 0, None after the last one'''
+    position = [recording.at(start) if start is not None else 0]
+    origin = [] # perf_counter and timestamp of the first replayed record
+    def source():
+        if position[0] >= len(recording):
+            return None
+        record = recording.records[position[0]]
+        if speed:
+            if not origin:
+                origin[:] = time.perf_counter(), record["time"]
+            delay = origin[0] + (record["time"] - origin[1]) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        position[0] += 1
+        sample = record["sample"]
+        return float(record["time"]), sample.item() if sample.dtype.names else np.array(sample)
+    source.timed = True
+    return source
+
+
+def replaystart(recording, start=None):
+    '''Timestamp of start in recording, seconds after its first sample or an ISO date and time, default its first
+    sample, None if it is empty'''
+    if start is None:
+        return float(recording.records["time"][0]) if len(recording) else None
+    try:
+        return float(recording.records["time"][0]) + float(start)
+    except ValueError:
+        return dt.datetime.fromisoformat(start).timestamp()
+
+
+def feed(source, record=None, playback=None, speed=1., start=None, dtype=None):
+    '''Acquisition source of a live plotter: source, or replay() of the recording file playback instead of it from
+    start (seconds after its first sample or an ISO date and time), or source recorded to the file record'''
+    if playback:
+        recording = Recording(playback)
+        print("Replaying %i samples of %s at %s" % (len(recording), playback, "%gx" % speed if speed else "full speed"))
+        return replay(recording, speed, replaystart(recording, start))
+    if record:
+        return recorded(source, Recording(record, dtype))
+    return source
+
+
+def began(record=None, playback=None, speed=1., start=None, dtype=None):
+    '''Time the data of a live plotter begin at for the keyword arguments of feed(): now, or the first replayed
+    sample'''
+    if playback:
+        return replaystart(Recording(playback), start) or time.time()
+    return time.time()
+
+
+def options(argv, rate=None):
+    '''Command line options of the live plotters --rate [samples per second] --frames [to draw before exiting]
+    --stats [JSON lines file of FrameStats, - for stdout] --overlay --record [file] | --replay [file]
+    --speed [factor, 0 for as fast as possible] --start [seconds into the recording or ISO time],
+    returns rate, frames, stats file, overlay and the keyword arguments of feed()'''
+    frames = None
+    file = None
+    overlay = False
+    recording = {}
+    opts, args = getopt.getopt(argv, "", ["rate=", "frames=", "stats=", "overlay", "record=", "replay=", "speed=", "start="])
+    for opt, arg in opts:
+        if opt == "--rate":
+            rate = float(arg)
+        elif opt == "--frames":
+            frames = int(arg)
+        elif opt == "--stats":
+            file = arg
+        elif opt == "--overlay":
+            overlay = True
+        elif opt == "--speed":
+            recording["speed"] = float(arg)
+        elif opt == "--replay":
+            recording["playback"] = arg
+        elif opt in ("--record", "--start"):
+            recording[opt[2:]] = arg
+    return rate, frames, file, overlay, recording
+
+
+def lorentzian(x, amplitude, peak, fwhm, offset=0.):
+    '''Lorentzian of height amplitude at peak with full width at half maximum fwhm on a constant offset'''
+    return amplitude / (1. + ((x - peak) * 2. / fwhm)**2) + offset
+
+
+class LorentzFitter:
+    '''Least-squares fit of a lorentzian() peak to a spectrum with Levenberg-Marquardt steps using the analytic
+    Jacobian. Each fit starts from the result of the previous one if that matches better than a guess from
+    the highest point, so a slowly moving tune takes few iterations.'''
+    def __init__(self, maxiter=50, tol=1e-10):
+        self.maxiter = maxiter
+        self.tol = tol # relative change of the squared residuals to stop at
+        self.params = None # amplitude, peak, fwhm, offset of the last fit
+        self.iterations = 0
+        self.latency = 0. # seconds taken by the last fit
+
+    def guess(self, x, y):
+        '''Start parameters from the highest point and the width of the region above half its height'''
+        offset = np.median(y)
+        k = np.argmax(y)
+        amplitude = y[k] - offset
+        step = (x[-1] - x[0]) / (len(x) - 1)
+        return np.array([amplitude, x[k], max(np.count_nonzero(y > offset + amplitude / 2) * step, abs(step)), offset])
+
+    def jacobian(self, x, params):
+        '''Derivatives of lorentzian() by amplitude, peak, fwhm and offset as columns'''
+        amplitude, peak, fwhm, offset = params
+        u = (x - peak) * 2. / fwhm
+        q = 1. / (1. + u**2)
+        jacobian = np.empty((len(x), 4))
+        jacobian[:, 0] = q
+        jacobian[:, 1] = 4. * amplitude * u * q**2 / fwhm
+        jacobian[:, 2] = jacobian[:, 1] * u / 2.
+        jacobian[:, 3] = 1.
+        return jacobian
+
+    def fit(self, x, y):
+        '''Fit spectrum y at frequencies x, returns amplitude, peak, fwhm and offset'''
+        start = time.perf_counter()
+        x = np.asarray(x, dtype = float)
+        y = np.asarray(y, dtype = float)
+        params = self.guess(x, y)
+        if self.params is not None and self.cost(x, y, self.params) < self.cost(x, y, params): # Warm start unless the tune jumped
+            params = self.params
+        params, self.iterations = self.minimize(x, y, params)
+        self.params = params
+        self.latency = time.perf_counter() - start
+        return params
+
+    def cost(self, x, y, params):
+        '''Sum of squared residuals of lorentzian() with params'''
+        residual = y - lorentzian(x, *params)
+        return residual @ residual
+
+    def minimize(self, x, y, params):
+        '''Levenberg-Marquardt iterations from params, returns the best parameters and number of iterations'''
+        residual = y - lorentzian(x, *params)
+        cost = residual @ residual
+        damping = 1e-3
+        for iteration in range(1, self.maxiter + 1):
+            jacobian = self.jacobian(x, params)
+            normal = jacobian.T @ jacobian
+            try:
+                step = np.linalg.solve(normal + damping * np.diag(np.diag(normal)), jacobian.T @ residual)
+            except np.linalg.LinAlgError:
+                break
+            trial = params + step
+            residual = y - lorentzian(x, *trial)
+            trialcost = residual @ residual
+            if trialcost < cost: # Accept, move towards Gauss-Newton
+                converged = cost - trialcost <= self.tol * cost
+                params, cost = trial, trialcost
+                damping /= 10.
+                if converged:
+                    break
+            else: # Reject, move towards gradient descent
+                residual = y - lorentzian(x, *params)
+                damping *= 10.
+                if damping > 1e10:
+                    break
+        return params, iteration
+
+
+class FieldGrid:
+    '''Mean and count of values at scattered points (x, y) per cell of a regular grid of bins over extent
+    ((x0, x1), (y0, y1)), points outside extent and NaN values are left out. Points are added in chunks of
+    chunksize by np.bincount over the flat cell numbers, so millions of them take one pass and temporary
+    memory for one chunk only.'''
+    def __init__(self, extent, bins=(200, 200), chunksize=1 << 20):
+        self.extent = tuple(tuple(float(v) for v in limits) for limits in extent)
+        self.bins = tuple(bins)
+        self.chunksize = chunksize
+        self.sums = np.zeros(self.bins[0] * self.bins[1])
+        self.counts = np.zeros(self.bins[0] * self.bins[1], dtype = np.int64)
+
+    def cells(self, x, y):
+        '''Flat cell numbers of points x, y and the mask of those inside the grid'''
+        index = []
+        inside = np.ones(len(x), dtype = bool)
+        for values, (low, high), n in zip((x, y), self.extent, self.bins):
+            values = np.asarray(values, dtype = float)
+            inside &= (values >= low) & (values <= high)
+            index.append(np.minimum(((values - low) * (n / (high - low))).astype(np.intp), n - 1)) # high in the last bin
+        return index[0] * self.bins[1] + index[1], inside
+
+    def add(self, x, y, values):
+        '''Add values at points x, y'''
+        for n in range(0, len(x), self.chunksize):
+            chunk = slice(n, n + self.chunksize)
+            v = np.asarray(values[chunk], dtype = float)
+            cells, inside = self.cells(x[chunk], y[chunk])
+            inside &= np.isfinite(v)
+            cells = cells[inside]
+            self.sums += np.bincount(cells, weights = v[inside], minlength = len(self.sums))
+            self.counts += np.bincount(cells, minlength = len(self.counts))
+
+    @property
+    def count(self):
+        '''Points per cell as bins array'''
+        return self.counts.reshape(self.bins)
+
+    @property
+    def mean(self):
+        '''Mean value per cell as bins array, NaN for empty cells'''
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return (self.sums / self.counts).reshape(self.bins)
+
+    def centers(self):
+        '''Cell centers as meshgrid arrays X, Y of shape bins'''
+        axes = [low + (np.arange(n) + .5) * (high - low) / n for (low, high), n in zip(self.extent, self.bins)]
+        return np.meshgrid(*axes, indexing = 'ij')
+
+
+FACECOST = 2e-5 # seconds to draw one face of a 3-D surface, first guess until a draw was timed
+
+
+def stride(shape, budget, facecost=FACECOST):
+    '''Equal row and column stride to draw a surface of a grid of shape with at most budget / facecost faces,
+    so its draw takes about budget seconds'''
+    faces = max(budget / facecost, 1.)
+    return max(int(np.ceil(np.sqrt(shape[0] * shape[1] / faces))), 1)
@@ -3,38 +3,266 @@
 """
 Created on Mi Okt 21 18:51:50 2015
 
-@author:    Sebastian Mey, Institut für Kernphysik, Forschungszentrum Jülich GmbH            
+@author:    Sebastian Mey, Institut für Kernphysik, Forschungszentrum Jülich GmbH
             s.mey@fz-juelich.de
 """
-import os, paramiko, sys
-from scp import SCPClient
+import getopt, glob, os, socket, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
 
-    
-def main(argv):
-    sshIP = "snoopy.cc.kfa-juelich.de"
-    sshUser = "cosy"
-    sshPWD = "rin.ran"
-    ifile =  "/mnt/cc-x/smb/fsv/update"
 
+HOST = "snoopy.cc.kfa-juelich.de" # default host, an alias or user@host[:port] like ssh
+USER = "cosy" # unless given with the host or in ~/.ssh/config
+UPDATE = "/mnt/cc-x/smb/fsv/update"
+PHASES = [0, 1, 2, 7] # trajectory files of fittest_classbased.py
+BLOCK = 1 << 15 # bytes read from an SFTP channel at once
+
+
+def usage():
+    '''Usage function'''
+    print("""Fetch files over SFTP, several at once through one SSH connection, skipping unchanged ones
+
+Usage: %s -h -H [host] -d [directory] -i [basename] -j [channels] -C --selftest [remote files]
+
+-h                  Show this help message and exit
+-H [host]           Alias in ~/.ssh/config or [user@]host[:port], default %s@%s
+                    Authenticates with the keys of the config, the SSH agent or ~/.ssh, never a password
+-d [directory]      Local directory to fetch to, default .
+-i [basename]       Fetch the trajectory files of remote basename of fittest_classbased.py
+-j [channels]       Number of files fetched in parallel over SFTP channels of the connection, default 4
+-C                  Compress the SSH connection
+--selftest          Fetch from a local SFTP server stand-in, check skipping and resuming and exit
+[remote files]      Remote paths to fetch, default %s without -i
+""" % (sys.argv[0], USER, HOST, UPDATE))
+
+
+def connect(host, compress=False, pkey=None, hostkey=None):
+    '''SSH client connected to host, an alias in ~/.ssh/config or [user@]host[:port], authenticated by pkey or the
+    identity files of the config, the SSH agent or the keys in ~/.ssh. The host key must be known, or be hostkey.'''
+    user, _, host = host.rpartition("@")
+    host, _, port = host.partition(":")
+    config = paramiko.SSHConfig()
+    path = os.path.expanduser("~/.ssh/config")
+    if os.path.exists(path):
+        config = paramiko.SSHConfig.from_path(path)
+    options = config.lookup(host)
+    host = options["hostname"]
+    port = int(port or options.get("port", 22))
     ssh = paramiko.SSHClient()
     ssh.load_system_host_keys()
-    ssh.load_host_keys(os.path.expanduser('~/.ssh/known_hosts'))
+    if hostkey is not None:
+        ssh.get_host_keys().add(host if port == 22 else "[%s]:%i" % (host, port), hostkey.get_name(), hostkey)
+    ssh.connect(hostname = host, port = port, username = user or options.get("user", USER),
+                pkey = pkey, key_filename = options.get("identityfile"), compress = compress,
+                allow_agent = pkey is None, look_for_keys = pkey is None)
+    return ssh
+
+
+def fetch(sftp, remote, local):
+    '''Copy remote to local unless local has the size and modification time of remote. The copy goes to a
+    partial file named after the size and mtime of remote, so an interrupted copy of the same version of remote
+    is resumed, and replaces local when complete. Returns "unchanged", "resumed" or "fetched" and the bytes read.'''
+    attributes = sftp.stat(remote)
+    size, mtime = attributes.st_size, attributes.st_mtime
+    if os.path.exists(local) and os.path.getsize(local) == size and int(os.path.getmtime(local)) == mtime:
+        return "unchanged", 0
+    partial = "%s.%i-%i.part" % (local, size, mtime)
+    for stale in glob.glob(glob.escape(local) + ".*.part"): # of other versions of remote
+        if stale != partial:
+            os.remove(stale)
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if offset > size:
+        offset = 0
+    with sftp.open(remote, 'rb') as source, open(partial, 'ab' if offset else 'wb') as target:
+        source.seek(offset)
+        source.prefetch(size) # Pipelined reads of the rest, no round trip per block
+        while True:
+            data = source.read(BLOCK)
+            if not data:
+                break
+            target.write(data)
+    os.utime(partial, (time.time(), mtime))
+    os.replace(partial, local)
+    return "resumed" if offset else "fetched", size - offset
+
+
+def fetchall(ssh, remotes, directory=".", jobs=4):
+    '''Fetch remotes into directory through jobs SFTP channels of the transport of ssh in parallel,
+    returns the result of fetch() of each, None where it failed'''
+    transport = ssh.get_transport()
+    channels = threading.local() # one SFTP channel per thread, all on the one authenticated transport
+    clients = []
+    def task(remote):
+        if not hasattr(channels, "sftp"):
+            channels.sftp = paramiko.SFTPClient.from_transport(transport)
+            clients.append(channels.sftp)
+        local = os.path.join(directory, os.path.basename(remote))
+        start = time.perf_counter()
+        try:
+            status, transferred = fetch(channels.sftp, remote, local)
+        except (IOError, paramiko.SSHException) as err:
+            print("Could not fetch %s: %s" % (remote, err))
+            return None
+        elapsed = time.perf_counter() - start
+        print("%s %s to %s, %i bytes in %.2f s" % (status.capitalize(), remote, local, transferred, elapsed))
+        return status, transferred
+    try:
+        with ThreadPoolExecutor(max(min(jobs, len(remotes)), 1)) as pool:
+            return list(pool.map(task, remotes))
+    finally:
+        for sftp in clients:
+            sftp.close()
+
+
+class StandInServer(paramiko.ServerInterface):
+    '''SSH server side accepting the public key key for any user, with sessions for the SFTP subsystem only'''
+    def __init__(self, key):
+        self.key = key
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL if key == self.key else paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class StandInSFTP(paramiko.SFTPServerInterface):
+    '''Read-only SFTP of local files, remote paths are local paths'''
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            handle = paramiko.SFTPHandle(flags)
+            handle.readfile = open(path, 'rb')
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return handle
+
+
+def standin(hostkey, clientkey):
+    '''Serve StandInSFTP on a local port in the background, returns the port and a function closing the server'''
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    transports = []
+    def serve():
+        while True:
+            try:
+                connection, address = listener.accept()
+            except OSError: # Closed
+                return
+            transport = paramiko.Transport(connection)
+            transport.use_compression(True) # Used if the client asks for it
+            transport.add_server_key(hostkey)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, StandInSFTP)
+            transport.start_server(server = StandInServer(clientkey))
+            transports.append(transport)
+    thread = threading.Thread(target = serve, daemon = True)
+    thread.start()
+    def close():
+        listener.close()
+        thread.join(1.)
+        for transport in transports:
+            transport.close()
+    return listener.getsockname()[1], close
+
+
+def selftest(jobs=4, compress=False):
+    '''Fetch generated files from standin() with fetchall() and check they are fetched, then skipped when
+    unchanged, resumed from a partial copy and fetched again when changed remotely, returns True if they are'''
+    hostkey = paramiko.RSAKey.generate(2048)
+    clientkey = paramiko.RSAKey.generate(2048)
+    port, close = standin(hostkey, clientkey)
+    ok = True
+    with tempfile.TemporaryDirectory() as remotedir, tempfile.TemporaryDirectory() as localdir:
+        remotes = [os.path.join(remotedir, "run_%s-pi-quarter_small_trajectory.dat" % phase) for phase in PHASES]
+        for k, remote in enumerate(remotes):
+            with open(remote, 'wb') as f:
+                f.write(os.urandom((k + 1) << 20))
+        ssh = connect("%s@127.0.0.1:%i" % (USER, port), compress, clientkey, hostkey)
+        def check(what, expected):
+            results = fetchall(ssh, remotes, localdir, jobs)
+            same = all(open(remote, 'rb').read() == open(os.path.join(localdir, os.path.basename(remote)), 'rb').read() for remote in remotes)
+            passed = same and [status for status, transferred in results] == [status for status, transferred in expected] \
+                and all(transferred == size for (status, transferred), (s, size) in zip(results, expected))
+            print("%s: %s" % (what, "ok" if passed else "FAILED %s" % results))
+            return passed
+        sizes = [os.path.getsize(remote) for remote in remotes]
+        ok &= check("Fetch", [("fetched", size) for size in sizes])
+        ok &= check("Unchanged", [("unchanged", 0) for size in sizes])
+        local = os.path.join(localdir, os.path.basename(remotes[0])) # Interrupted after half of the first file
+        attributes = os.stat(remotes[0])
+        partial = "%s.%i-%i.part" % (local, attributes.st_size, attributes.st_mtime)
+        with open(local, 'rb') as f, open(partial, 'wb') as g:
+            g.write(f.read(sizes[0] // 2))
+        os.remove(local)
+        ok &= check("Resume", [("resumed", sizes[0] - sizes[0] // 2)] + [("unchanged", 0) for size in sizes[1:]])
+        with open(remotes[1], 'r+b') as f: # Same size, new content and mtime
+            f.write(os.urandom(16))
+        os.utime(remotes[1], (attributes.st_atime, attributes.st_mtime + 10))
+        ok &= check("Changed", [("unchanged", 0), ("fetched", sizes[1])] + [("unchanged", 0) for size in sizes[2:]])
+        close() # Server first, the client then sees an orderly disconnect
+        ssh.close()
+    return ok
+
+
+def main(argv):
+    host = HOST
+    directory = "."
+    basename = None
+    jobs = 4
+    compress = False
+    test = False
     try:
-        ssh.connect(hostname = sshIP, username = sshUser, password = sshPWD, look_for_keys = False, allow_agent = False)
-        print("Connected to %s@%s via SSH." %(sshUser, sshIP))
-    except (paramiko.AuthenticationException, paramiko.SSHException) as err:
-        print("Could not connect to %s@%s: %s" %(sshUser, sshIP, err))
+        opts, args = getopt.getopt(argv, "hH:d:i:j:C", ["selftest"])
+    except getopt.GetoptError as err:
+        print(str(err) + "\n")
+        usage()
         sys.exit(2)
-    scp = SCPClient(ssh.get_transport())
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt == "-H":
+            host = arg
+        elif opt == "-d":
+            directory = arg
+        elif opt == "-i":
+            basename = arg
+        elif opt == "-j":
+            jobs = int(arg)
+        elif opt == "-C":
+            compress = True
+        elif opt == "--selftest":
+            test = True
+    if test:
+        sys.exit(0 if selftest(jobs, compress) else 1)
+    remotes = list(args)
+    if basename:
+        remotes += [basename + "_%s-pi-quarter_small_trajectory.dat" % phase for phase in PHASES]
+    remotes = remotes or [UPDATE]
     try:
-        scp.get(ifile)
-        print("File %s copied to ." %ifile)
-        ssh.close()
-    except:
-        print("Could not find %s." % ifile)
-        ssh.close()  
+        ssh = connect(host, compress)
+        print("Connected to %s via SSH%s." % (host, " with compression" if compress else ""))
+    except (paramiko.AuthenticationException, paramiko.SSHException, OSError) as err:
+        print("Could not connect to %s: %s" % (host, err))
         sys.exit(2)
+    results = fetchall(ssh, remotes, directory, jobs)
+    ssh.close()
+    if None in results:
+        sys.exit(2)
+
 
-                    
 if __name__ == "__main__":
     main(sys.argv[1:])
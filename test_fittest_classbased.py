@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Tests of the binary cache of fittest_classbased.py: results of -u after appends match a -r rebuild
+'''
+import numpy as np
+import pytest
+import fittest_classbased as fit
+
+
+COLUMNS = ["x", "Bx", "F_x", "absE"]
+
+
+def block(id, rows, seed):
+    '''Text of particle block id with rows lines of random raw columns, t increasing along the trajectory'''
+    values = np.random.default_rng(seed).uniform(-1., 1., (rows, len(fit.RAW)))
+    values[:, fit.RAW.index("t")] = np.arange(rows) * 1e-9
+    return "ID %i\n" % id + "".join(" ".join("%.9e" % v for v in row) + "\n" for row in values)
+
+
+def reduced(file, rebuild=False):
+    ids, outs, ints = fit.reducefile(file, COLUMNS, rebuild = rebuild)
+    return np.asarray(ids), np.asarray(outs), np.asarray(ints)
+
+
+def assertsame(a, b):
+    for x, y in zip(a, b):
+        np.testing.assert_allclose(x, y, rtol = 1e-12, equal_nan = True)
+
+
+@pytest.fixture
+def trajectories(tmp_path):
+    path = tmp_path / "run_0-pi-quarter_small_trajectory.dat"
+    path.write_text(block(1, 20, 1) + block(2, 30, 2))
+    return str(path)
+
+
+def test_update(trajectories):
+    '''Appended blocks, a grown last block and a last line still being written'''
+    first = reduced(trajectories)
+    assert list(first[0]) == [1, 2]
+    with open(trajectories, 'a') as f: # Whole blocks
+        f.write(block(3, 25, 3) + block(4, 10, 4))
+    updated = reduced(trajectories)
+    assert list(updated[0]) == [1, 2, 3, 4]
+    assertsame(updated, reduced(trajectories, rebuild = True))
+    grown = block(4, 15, 5).split("\n", 1)[1] # Rows of the last block without header
+    with open(trajectories, 'a') as f:
+        f.write(grown)
+    updated = reduced(trajectories)
+    assertsame(updated, reduced(trajectories, rebuild = True))
+    line, rest = block(5, 12, 6).split("\n", 1)[1].split(" ", 1)
+    with open(trajectories, 'a') as f: # Header of a new block and the first number of its first line
+        f.write("ID 5\n" + line)
+    assertsame(reduced(trajectories), updated)
+    with open(trajectories, 'a') as f:
+        f.write(" " + rest)
+    updated = reduced(trajectories)
+    assert list(updated[0]) == [1, 2, 3, 4, 5]
+    assertsame(updated, reduced(trajectories, rebuild = True))
+
+
+def test_no_final_newline(trajectories):
+    '''The end of a finished file ends its last line'''
+    with open(trajectories, 'a') as f:
+        f.write(block(3, 3, 3).rstrip("\n"))
+    ids, data = fit.readcached(trajectories)
+    assert np.count_nonzero(ids == 3) == 3
+
+
+def test_no_particles(tmp_path):
+    '''Only the skipped particle, read from the file and then from the cache'''
+    path = tmp_path / "run_0-pi-quarter_small_trajectory.dat"
+    path.write_text(block(fit.SKIP[0], 5, 1))
+    for k in range(2):
+        ids, data = fit.readcached(str(path))
+        assert fit.lorentz(ids, data).shape == (len(fit.COLUMNS), 0)
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Soak test of plottest_v5.py: a day of simulated NMR data drawn headless
+'''
+import threading, time, tracemalloc
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+import plottest_v5 as v5
+from plottools import Acquisition, FrameStats
+
+
+def soak(frames, hours, seed=0):
+    '''Draw frames spread over hours of simulated time, publishing a sample through a started Acquisition before
+    10% of them. Returns the number of artists of the axes after the first and the last frame, memory growth per
+    frame in bytes, the points of the collection and the samples dropped.'''
+    rng = np.random.default_rng(seed)
+    now = [time.time()]
+    due = threading.Semaphore(0) # samples the source may publish
+    def source():
+        return v5.gendata() if due.acquire(timeout = 1e-3) else None
+    v5.clock = lambda: now[0]
+    v5.acquisition = Acquisition(source)
+    v5.acquisition.start()
+    try:
+        v5.createplot(60, .1)
+        v5.animate(v5.f).stop() # No event loop, frames are drawn here
+        v5.f.canvas.draw() # Caches the background
+        checkpoint = max(frames // 10, 1)
+        artists = []
+        memory = []
+        published = 0
+        tracemalloc.start()
+        for frame in range(frames):
+            now[0] += hours * 3600. / frames
+            if rng.random() > 0.9:
+                published += 1
+                due.release()
+                while v5.acquisition.produced < published: # In the queue before the frame drains it
+                    time.sleep(1e-4)
+            v5.step()
+            if frame in (0, frames - 1):
+                artists.append(len(v5.ax.get_children()))
+            if frame % checkpoint == 0:
+                memory.append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.stop()
+    finally:
+        v5.acquisition.stop()
+    growth = (memory[-1] - memory[min(1, len(memory) - 1)]) / max((len(memory) - 2) * checkpoint, 1)
+    return artists[0], artists[-1], growth, len(v5.coll.get_offsets()), v5.acquisition.dropped
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    '''plottest_v5 without printing every sample, its globals restored after the test'''
+    for name in ("clock", "acquisition", "stats", "verbose"):
+        monkeypatch.setattr(v5, name, getattr(v5, name, None), raising = False)
+    v5.verbose = False
+    v5.stats = FrameStats("plottest_v5")
+    yield
+    if hasattr(v5, "f"):
+        plt.close(v5.f)
+
+
+def test_soak(monitor):
+    '''As many artists and points after a day as after the first frame and flat memory. Memory may grow by a few
+    bytes per frame while bounded caches of matplotlib (e.g. text layouts of new tick labels) fill up.'''
+    first, last, growth, points, dropped = soak(2000, 24.)
+    assert last == first
+    assert points == 60
+    assert growth < 256
+    assert dropped == 0
+
+
+def test_soak_few_frames(monitor):
+    '''Fewer frames than memory checkpoints'''
+    first, last, growth, points, dropped = soak(5, 1.)
+    assert last == first
+    assert dropped == 0